@@ -1,15 +1,43 @@
-from .db import create_user, get_user_by_username
-from .config import JWT_SECRET, JWT_EXP_SECONDS
+import hmac
+import time
+from .cache import LRUCache
+from .db import create_user, get_user_by_username, set_user_password
+from .config import JWT_SECRET, JWT_EXP_SECONDS, TOKEN_CACHE_SIZE
 from .jwt import encode_jwt, decode_jwt
+from .metrics import Histogram, timed
+from .passwords import (
+    TooManyAttempts,
+    hash_password,
+    needs_rehash,
+    run_kdf,
+    user_limiter,
+    verify_password,
+    verify_unknown_user,
+)
+from .pool import run_db
 
-def register_user(username: str, password: str) -> int:
-    return create_user(username=username, password=password)
+# signature segment -> (token, payload) for tokens that already passed decode_jwt
+token_cache = LRUCache(TOKEN_CACHE_SIZE, name="token")
 
-def authenticate_user(username: str, password: str):
-    user = get_user_by_username(username)
-    if not user:
-        return None
-    if user.get("password") != password:
+JWT_VERIFY_SECONDS = Histogram("jwt_verify_seconds", "verify_token calls, cached or decoded, valid or not")
+
+async def register_user(username: str, password: str) -> int:
+    password_hash = await run_kdf(hash_password, password)
+    return await run_db(create_user, username=username, password=password_hash)
+
+async def authenticate_user(username: str, password: str):
+    try:
+        async with user_limiter(username):
+            user = await run_db(get_user_by_username, username)
+            if not user:
+                return await run_kdf(verify_unknown_user, password) or None
+            stored = user.get("password") or ""
+            if not await run_kdf(verify_password, stored, password):
+                return None
+            if needs_rehash(stored):
+                # Legacy plaintext (or old-cost) row: upgrade it now that we know the password.
+                await run_db(set_user_password, int(user["id"]), stored, await run_kdf(hash_password, password))
+    except TooManyAttempts:
         return None
     return user
 
@@ -17,4 +45,20 @@ def issue_token(user_id: int, username: str) -> str:
     return encode_jwt({"sub": user_id, "username": username}, JWT_SECRET, JWT_EXP_SECONDS)
 
 def verify_token(token: str):
-    return decode_jwt(token, JWT_SECRET)
+    with timed(JWT_VERIFY_SECONDS):
+        return _verify_token(token)
+
+def _verify_token(token: str):
+    signature = token.rpartition(".")[2]
+    cached = token_cache.get(signature)
+    if cached is not None and hmac.compare_digest(cached[0], token):
+        payload = cached[1]
+        exp = int(payload.get("exp", 0))
+        if exp and exp < time.time():
+            token_cache.pop(signature)
+            raise ValueError("Token expired")
+        return payload
+
+    payload = decode_jwt(token, JWT_SECRET)
+    token_cache.set(signature, (token, payload))
+    return payload
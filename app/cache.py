@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+from .metrics import CollectedCounter, Gauge
+
+# name -> cache, for the metrics below; only caches given a name are listed.
+caches = {}
+
+
+class LRUCache:
+    """Bounded least-recently-used map with hit/miss counters; thread-safe."""
+
+    def __init__(self, maxsize: int, name: str = None):
+        if name is not None:
+            caches[name] = self
+        self.maxsize = max(1, maxsize)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation; a fill computed before it is discarded.
+        self.generation = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None) -> None:
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose entries also expire `ttl` seconds after being set."""
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float, name: str = None):
+        super().__init__(maxsize, name)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super().get(key, self._MISSING)
+        if entry is self._MISSING:
+            return default
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+                self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, generation=None) -> None:
+        super().set(key, (value, time.monotonic() + self.ttl), generation)
+
+
+Gauge("cache_entries", "Entries held", lambda: {(name,): len(cache) for name, cache in caches.items()}, labels=("cache",))
+CollectedCounter("cache_hits_total", "Lookups answered from the cache", lambda: {(name,): cache.hits for name, cache in caches.items()}, labels=("cache",))
+CollectedCounter("cache_misses_total", "Lookups not in the cache (or expired)", lambda: {(name,): cache.misses for name, cache in caches.items()}, labels=("cache",))
@@ -0,0 +1,227 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import secrets
+from . import ws
+from .config import CLUSTER_LOCK_PATH, CLUSTER_SOCKET_PATH, CLUSTER_RETRY_SECONDS, CLUSTER_PEER_BUFFER_BYTES
+from .db import load_device_registry, ownership_cache, reload_badges, reload_devices
+from .pool import run_db
+from .registry import registry
+
+log = logging.getLogger(__name__)
+
+# Max size of one NDJSON line (large invalidation batches).
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+class Cluster:
+    """
+    Coordinates several uvicorn workers sharing one database.
+
+    The worker holding an exclusive flock on CLUSTER_LOCK_PATH is the leader:
+    it runs the ingestion services (MQTT consumer, ingest worker, retention)
+    and a hub on the CLUSTER_SOCKET_PATH Unix socket. Every other worker
+    connects to the hub. Messages are NDJSON lines:
+
+        {"t": "hello", "stream": "...", "seq": n}    hub -> follower, on connect
+        {"t": "publish", "msgs": [{...}, ...]}       follower -> hub, new broadcasts
+        {"t": "event", "msgs": [{...}, ...]}         hub -> followers, stamped broadcasts
+        {"t": "invalidate", "pins": [...], "links": [[user_id, pin], ...], "badges": [...]}
+
+    The leader stamps every broadcast with the next seq of its event stream
+    (see ws.EventLog), so all workers hold the same replay history and a
+    dashboard can resume on any of them. Invalidations are delivered locally
+    and forwarded to every other follower. When the leader dies its lock is
+    released and the next follower to notice the closed hub connection takes
+    over, starting a new stream.
+    """
+
+    def __init__(self, start_leader_services):
+        self.start_leader_services = start_leader_services
+        self.loop = None
+        self.lock_fd = None
+        self.is_leader = False
+        self.peers = set()
+        self.hub = None
+        self.pending_pins = set()
+        self.pending_links = set()
+        self.pending_badges = set()
+        self.flush_scheduled = False
+
+    def try_acquire_leadership(self) -> bool:
+        fd = os.open(CLUSTER_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode("utf-8"))
+        self.lock_fd = fd
+        return True
+
+    def release_leadership(self) -> None:
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+        self.is_leader = False
+
+    async def run(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        registry.shared = True
+        registry.on_change = self.on_registry_change
+        ws.relay = self.relay_events
+        try:
+            while True:
+                if self.try_acquire_leadership():
+                    await self.lead()
+                else:
+                    await self.follow()
+                    await asyncio.sleep(CLUSTER_RETRY_SECONDS)
+        finally:
+            ws.relay = None
+            registry.on_change = None
+            self.release_leadership()
+
+    async def lead(self) -> None:
+        self.is_leader = True
+        ws.events.reset(secrets.token_hex(8))
+        if os.path.exists(CLUSTER_SOCKET_PATH):
+            os.unlink(CLUSTER_SOCKET_PATH)
+        server = await asyncio.start_unix_server(self.serve_peer, path=CLUSTER_SOCKET_PATH, limit=LINE_LIMIT)
+        # Followers may have written while there was no leader to relay it.
+        await run_db(load_device_registry)
+        tasks = self.start_leader_services()
+        log.info("worker %d is the ingestion leader", os.getpid())
+        try:
+            await asyncio.Future()
+        finally:
+            for task in tasks:
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+            server.close()
+            for peer in list(self.peers):
+                peer.close()
+            self.peers.clear()
+            if os.path.exists(CLUSTER_SOCKET_PATH):
+                os.unlink(CLUSTER_SOCKET_PATH)
+
+    async def serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        hello = {"t": "hello", "stream": ws.events.stream, "seq": ws.events.seq}
+        writer.write((json.dumps(hello) + "\n").encode("utf-8"))
+        self.peers.add(writer)
+        try:
+            while line := await reader.readline():
+                self.receive(line, origin=writer)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+
+    async def follow(self) -> None:
+        try:
+            reader, writer = await asyncio.open_unix_connection(CLUSTER_SOCKET_PATH, limit=LINE_LIMIT)
+        except OSError:
+            return
+        self.hub = writer
+        log.info("worker %d following the ingestion leader", os.getpid())
+        # Catch up on anything that changed while we were not connected.
+        await run_db(load_device_registry)
+        try:
+            while line := await reader.readline():
+                self.receive(line)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.hub = None
+            writer.close()
+
+    def send(self, message: dict, exclude=None) -> None:
+        data = (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+        self.send_raw(data, exclude)
+
+    def send_raw(self, data: bytes, exclude=None) -> None:
+        if self.is_leader:
+            for peer in list(self.peers):
+                if peer is exclude:
+                    continue
+                if peer.transport.get_write_buffer_size() > CLUSTER_PEER_BUFFER_BYTES:
+                    # A follower that cannot keep up is cut off; it reconnects and reloads.
+                    log.warning("dropping slow follower")
+                    self.peers.discard(peer)
+                    peer.close()
+                    continue
+                peer.write(data)
+        elif self.hub is not None:
+            self.hub.write(data)
+
+    def receive(self, line: bytes, origin=None) -> None:
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        kind = message.get("t")
+        if kind == "publish":
+            if self.is_leader:
+                self.publish(message["msgs"])
+            return
+        if self.is_leader:
+            self.send_raw(line, exclude=origin)
+        if kind == "hello":
+            ws.events.reset(message["stream"], int(message["seq"]))
+        elif kind == "event":
+            ws.receive_events(message["msgs"])
+        elif kind == "invalidate":
+            asyncio.create_task(
+                self.apply_invalidation(message.get("pins", []), message.get("links", []), message.get("badges", []))
+            )
+
+    async def apply_invalidation(self, pins, links, badges=()) -> None:
+        for user_id, pin in links:
+            ownership_cache.pop((user_id, pin))
+        if pins:
+            await run_db(reload_devices, pins)
+        if badges:
+            await run_db(reload_badges, badges)
+
+    def publish(self, msgs: list) -> None:
+        # Leader only: stamp, deliver here, then to every follower (the origin included).
+        self.send({"t": "event", "msgs": ws.publish(msgs)})
+
+    def relay_events(self, msgs: list) -> None:
+        if self.is_leader:
+            self.publish(msgs)
+        elif self.hub is not None:
+            self.send({"t": "publish", "msgs": msgs})
+        else:
+            # Between leaders: deliver locally, unstamped, rather than lose them.
+            ws.deliver(msgs)
+
+    def on_registry_change(self, pins, links=(), badges=()) -> None:
+        # Called on DB executor threads; hop onto the loop and coalesce.
+        try:
+            self.loop.call_soon_threadsafe(self.queue_invalidation, list(pins), list(links), list(badges))
+        except RuntimeError:
+            pass  # loop already closed during shutdown
+
+    def queue_invalidation(self, pins, links, badges=()) -> None:
+        self.pending_pins.update(pins)
+        self.pending_links.update(links)
+        self.pending_badges.update(badges)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush_invalidations)
+
+    def flush_invalidations(self) -> None:
+        self.flush_scheduled = False
+        pins, self.pending_pins = self.pending_pins, set()
+        links, self.pending_links = self.pending_links, set()
+        badges, self.pending_badges = self.pending_badges, set()
+        if pins or links or badges:
+            self.send({"t": "invalidate", "pins": sorted(pins), "links": [list(link) for link in links], "badges": sorted(badges)})
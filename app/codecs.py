@@ -0,0 +1,229 @@
+import json
+import struct
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+# Binary payloads start with this byte; JSON never does.
+STRUCT_MAGIC = 0xC5
+
+# Device contract for counts tagged with a seq (JSON "seq"/"boot", binary
+# FLAG_SEQ/FLAG_BOOT):
+# - seq goes up by one per new count message (uint32, wrapping); a re-sent
+#   message keeps its seq. A seq at or up to DEVICE_SEQ_WINDOW behind the
+#   last one applied for the pin is a redelivery and is dropped.
+# - boot names the run of the seq counter (uint16). A device that starts its
+#   seq over (reboot, battery swap, flash wipe) must send a new boot, e.g. a
+#   boot counter kept in flash: the first message with a different boot is
+#   applied whatever its seq, and the window restarts from it. Without boot,
+#   messages after a restart are dropped until the seq passes the window.
+
+# Flag bits of a binary count payload: a uint32 device seq follows the
+# header, then (with FLAG_BOOT) a uint16 boot, then (with FLAG_AGES) one age
+# per event.
+FLAG_AGES = 0x01
+FLAG_SEQ = 0x02
+FLAG_BOOT = 0x04
+
+# magic, flags, number of events
+_COUNT_HEADER = struct.Struct("!BBH")
+_SEQ = struct.Struct("!I")
+_BOOT = struct.Struct("!H")
+_AGE = struct.Struct("!H")
+# Most counts one message can carry, or ages it can list. A batch without
+# ages is applied as a single change of n; each age is its own log row.
+MAX_BATCH = 256
+# Largest age a binary count can carry: how far an event's ts can fall
+# behind the time its message was received.
+MAX_AGE_SECONDS = 0xFFFF
+MAX_SEQ = 0xFFFFFFFF
+MAX_BOOT = 0xFFFF
+
+
+class PayloadError(ValueError):
+    pass
+
+
+class PayloadCodec(ABC):
+    """
+    Turns an MQTT payload into what handle_message needs: for a count, the
+    device seq and boot of the message (None if it has none) and its events
+    in order, as (ts, n) pairs of n counts at ts; for any other action, its
+    fields.
+    Codecs with a `magic` first byte are picked by that byte; the rest go
+    to JSON.
+    """
+
+    name = ""
+    magic: Optional[int] = None
+
+    @abstractmethod
+    def count_events(self, payload: bytes, ts: int) -> Tuple[Optional[int], Optional[int], List[Tuple[int, int]]]:
+        ...
+
+    @abstractmethod
+    def decode(self, payload: bytes) -> dict:
+        ...
+
+
+class EmptyCodec(PayloadCodec):
+    """A bare publish: one count now. Nothing to parse."""
+
+    name = "empty"
+
+    def count_events(self, payload: bytes, ts: int) -> Tuple[Optional[int], Optional[int], List[Tuple[int, int]]]:
+        return None, None, [(ts, 1)]
+
+    def decode(self, payload: bytes) -> dict:
+        raise PayloadError("empty payload")
+
+
+class JsonCodec(PayloadCodec):
+    """
+    The original format. A count body of {} (what devices have always sent)
+    is one event and is not parsed. An object can carry an optional device
+    "seq" (and "boot") and "n" counts (default 1, applied as one change of
+    n), e.g. {"boot": 3, "seq": 1042, "n": 7}; any other JSON value is one
+    event, as before. Bodies that are not JSON are malformed.
+    """
+
+    name = "json"
+
+    def count_events(self, payload: bytes, ts: int) -> Tuple[Optional[int], Optional[int], List[Tuple[int, int]]]:
+        if payload == b"{}":
+            return None, None, [(ts, 1)]
+        fields = self._load(payload)
+        if not isinstance(fields, dict):
+            return None, None, [(ts, 1)]
+        seq, boot, n = fields.get("seq"), fields.get("boot"), fields.get("n", 1)
+        if seq is not None and not _is_int(seq, 0, MAX_SEQ):
+            raise PayloadError(f"seq must be an integer 0..{MAX_SEQ}")
+        if boot is not None and (seq is None or not _is_int(boot, 0, MAX_BOOT)):
+            raise PayloadError(f"boot must be an integer 0..{MAX_BOOT}, with a seq")
+        if not _is_int(n, 1, MAX_BATCH):
+            raise PayloadError(f"n must be an integer 1..{MAX_BATCH}")
+        return seq, boot, [(ts, n)]
+
+    def decode(self, payload: bytes) -> dict:
+        value = self._load(payload)
+        if not isinstance(value, dict):
+            raise PayloadError("expected a JSON object")
+        return value
+
+    @staticmethod
+    def _load(payload: bytes):
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            raise PayloadError(str(e)) from None
+
+
+class StructCodec(PayloadCodec):
+    """
+    Fixed-layout binary, big-endian:
+
+        count:  B magic, B flags, H n                    n counts received now, as one change
+                ... with FLAG_SEQ: then I seq            the device's message seq
+                ... with FLAG_BOOT: then H boot          the run of that seq (needs FLAG_SEQ)
+                ... with FLAG_AGES: then n x H age       event i happened age[i] seconds before sending
+        other:  B magic, then the UTF-8 RFID uid         {"uuid": ...}
+
+    A device that batches sends one message for many counts (4 + 2n bytes
+    with ages, 4 without, plus 4 for a seq and 2 for a boot), n at most
+    MAX_BATCH. With ages each count is its own event, oldest first, applied
+    in that order.
+    """
+
+    name = "struct"
+    magic = STRUCT_MAGIC
+
+    def count_events(self, payload: bytes, ts: int) -> Tuple[Optional[int], Optional[int], List[Tuple[int, int]]]:
+        if len(payload) < _COUNT_HEADER.size:
+            raise PayloadError("short count header")
+        _, flags, n = _COUNT_HEADER.unpack_from(payload)
+        if not 0 < n <= MAX_BATCH:
+            raise PayloadError(f"n must be 1..{MAX_BATCH}")
+        offset = _COUNT_HEADER.size
+        seq = boot = None
+        if flags & FLAG_SEQ:
+            if len(payload) < offset + _SEQ.size:
+                raise PayloadError("short seq")
+            seq = _SEQ.unpack_from(payload, offset)[0]
+            offset += _SEQ.size
+        if flags & FLAG_BOOT:
+            if seq is None:
+                raise PayloadError("boot without seq")
+            if len(payload) < offset + _BOOT.size:
+                raise PayloadError("short boot")
+            boot = _BOOT.unpack_from(payload, offset)[0]
+            offset += _BOOT.size
+        if not flags & FLAG_AGES:
+            if len(payload) != offset:
+                raise PayloadError("unexpected bytes after count header")
+            return seq, boot, [(ts, n)]
+        if len(payload) != offset + n * _AGE.size:
+            raise PayloadError("count payload length does not match n")
+        ages = struct.unpack_from(f"!{n}H", payload, offset)
+        return seq, boot, [(ts - age, 1) for age in ages]
+
+    def decode(self, payload: bytes) -> dict:
+        try:
+            return {"uuid": payload[1:].decode("utf-8")}
+        except UnicodeDecodeError as e:
+            raise PayloadError(str(e)) from None
+
+
+def _is_int(value, low: int, high: int) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+
+
+def encode_counts(n: int = 1, ages=None, seq: Optional[int] = None, boot: Optional[int] = None) -> bytes:
+    """
+    A StructCodec count payload: n counts now, or one per entry of `ages`
+    (seconds ago); with `seq` (and `boot`), tagged with that device seq.
+    """
+    flags = 0
+    tail = b""
+    if seq is not None:
+        if not _is_int(seq, 0, MAX_SEQ):
+            raise ValueError(f"seq must be 0..{MAX_SEQ}")
+        flags |= FLAG_SEQ
+        tail = _SEQ.pack(seq)
+    if boot is not None:
+        if seq is None or not _is_int(boot, 0, MAX_BOOT):
+            raise ValueError(f"boot must be 0..{MAX_BOOT}, with a seq")
+        flags |= FLAG_BOOT
+        tail += _BOOT.pack(boot)
+    if ages is not None:
+        ages = list(ages)
+        n = len(ages)
+        flags |= FLAG_AGES
+        tail += struct.pack(f"!{n}H", *ages)
+    if not 0 < n <= MAX_BATCH:
+        raise ValueError(f"between 1 and {MAX_BATCH} counts")
+    return _COUNT_HEADER.pack(STRUCT_MAGIC, flags, n) + tail
+
+
+def encode_toggle(uuid: str) -> bytes:
+    return bytes([STRUCT_MAGIC]) + uuid.encode("utf-8")
+
+
+EMPTY = EmptyCodec()
+JSON = JsonCodec()
+_by_magic: Dict[int, PayloadCodec] = {}
+
+
+def register_codec(codec: PayloadCodec) -> None:
+    """Route payloads starting with `codec.magic` to `codec`."""
+    if codec.magic is None or codec.magic in b"{[ \t\r\n":
+        raise ValueError("a codec needs a magic byte JSON cannot start with")
+    _by_magic[codec.magic] = codec
+
+
+register_codec(StructCodec())
+
+
+def codec_for(payload: bytes) -> PayloadCodec:
+    """One length test and, for non-empty payloads, one dict lookup on the first byte."""
+    if not payload:
+        return EMPTY
+    return _by_magic.get(payload[0], JSON)
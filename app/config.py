@@ -9,9 +9,105 @@ load_dotenv()
 BROKER_URL = os.getenv("BROKER_URL", "mqtt://broker.emqx.io:1883")
 BROKER_TOPIC = os.getenv("BROKER_TOPIC", "ynov/bdx/lidl")
 SQLITE_DB_PATH = os.getenv("SQLITE_DB_PATH", "database.sqlite3")
+MQTT_OUTBOX_SIZE = int(os.getenv("MQTT_OUTBOX_SIZE", "1000"))
+MQTT_COMMAND_QOS = int(os.getenv("MQTT_COMMAND_QOS", "1"))
+# Commands the publisher keeps in flight at once, and how long a bulk request
+# may wait for room in the outbox.
+MQTT_PUBLISH_BATCH = int(os.getenv("MQTT_PUBLISH_BATCH", "100"))
+MQTT_ENQUEUE_TIMEOUT_SECONDS = float(os.getenv("MQTT_ENQUEUE_TIMEOUT_SECONDS", "5"))
+MQTT_RECONNECT_MIN_SECONDS = float(os.getenv("MQTT_RECONNECT_MIN_SECONDS", "0.5"))
+MQTT_RECONNECT_MAX_SECONDS = float(os.getenv("MQTT_RECONNECT_MAX_SECONDS", "30"))
+MQTT_SHARDS = int(os.getenv("MQTT_SHARDS", "8"))
+MQTT_SHARD_QUEUE_SIZE = int(os.getenv("MQTT_SHARD_QUEUE_SIZE", "1000"))
+# On shutdown or leader handover, how long the shards may keep handling
+# messages already received before the rest are dropped.
+MQTT_SHARD_DRAIN_SECONDS = float(os.getenv("MQTT_SHARD_DRAIN_SECONDS", "10"))
 JWT_SECRET = os.getenv("JWT_SECRET", "jwt")
 JWT_EXP_SECONDS = int(os.getenv("JWT_EXP_SECONDS", str(7 * 24 * 3600)))
 
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-16000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(128 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Switch a database created without auto_vacuum to INCREMENTAL at startup, so
+# retention can shrink the file. Takes one VACUUM: a full rebuild that blocks
+# every writer and needs about the database's size again in free disk.
+SQLITE_CONVERT_AUTO_VACUUM = os.getenv("SQLITE_CONVERT_AUTO_VACUUM", "0").lower() in ("1", "true", "yes")
+
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", str(2 ** 14)))
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_USER_CONCURRENCY = int(os.getenv("PASSWORD_USER_CONCURRENCY", "1"))
+PASSWORD_USER_MAX_PENDING = int(os.getenv("PASSWORD_USER_MAX_PENDING", "4"))
+
+BULK_MAX_PINS = int(os.getenv("BULK_MAX_PINS", "5000"))
+RFID_MAX_BADGES = int(os.getenv("RFID_MAX_BADGES", "16"))
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
+OWNERSHIP_CACHE_SIZE = int(os.getenv("OWNERSHIP_CACHE_SIZE", "16384"))
+OWNERSHIP_CACHE_TTL_SECONDS = float(os.getenv("OWNERSHIP_CACHE_TTL_SECONDS", "30"))
+
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0").lower() in ("1", "true", "yes")
+CLUSTER_LOCK_PATH = os.getenv("CLUSTER_LOCK_PATH", f"{SQLITE_DB_PATH}.leader.lock")
+CLUSTER_SOCKET_PATH = os.getenv("CLUSTER_SOCKET_PATH", f"{SQLITE_DB_PATH}.events.sock")
+CLUSTER_RETRY_SECONDS = float(os.getenv("CLUSTER_RETRY_SECONDS", "1"))
+CLUSTER_PEER_BUFFER_BYTES = int(os.getenv("CLUSTER_PEER_BUFFER_BYTES", str(8 * 1024 * 1024)))
+
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_READERS + 1)))
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop-oldest")
+WS_CONFLATE_WINDOW_MS = int(os.getenv("WS_CONFLATE_WINDOW_MS", "100"))
+WS_CONFLATE_MIN_MS = int(os.getenv("WS_CONFLATE_MIN_MS", "50"))
+WS_CONFLATE_MAX_MS = int(os.getenv("WS_CONFLATE_MAX_MS", "250"))
+WS_REPLAY_BUFFER_SIZE = int(os.getenv("WS_REPLAY_BUFFER_SIZE", "10000"))
+
+LOG_RETENTION_SECONDS = int(os.getenv("LOG_RETENTION_SECONDS", "0"))
+LOG_RETENTION_OVERRIDES = os.getenv("LOG_RETENTION_OVERRIDES", "")
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "archive")
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+RETENTION_CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", "1000"))
+RETENTION_PAUSE_MS = int(os.getenv("RETENTION_PAUSE_MS", "50"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))
+
+LOG_EXPORT_CHUNK_SIZE = int(os.getenv("LOG_EXPORT_CHUNK_SIZE", "1000"))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Per-category overrides, e.g. "mqtt=DEBUG,ingest=WARNING" (categories are app/ module names).
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_PIN_INTERVAL_SECONDS = float(os.getenv("LOG_PIN_INTERVAL_SECONDS", "10"))
+LOG_PIN_MAX = int(os.getenv("LOG_PIN_MAX", "10000"))
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_MS = int(os.getenv("INGEST_FLUSH_MS", "50"))
+# A count message whose device seq is at most this far behind the last one
+# applied for its pin (with the same boot) is a redelivery and is dropped;
+# further behind, or a new boot, means the device restarted its numbering.
+DEVICE_SEQ_WINDOW = int(os.getenv("DEVICE_SEQ_WINDOW", "1024"))
+
+def parse_retention_overrides(value: str) -> Dict[str, int]:
+    """Parse "pin=seconds,pin=seconds" into {pin: seconds}."""
+    overrides = {}
+    for item in value.split(","):
+        pin, _, seconds = item.partition("=")
+        if pin.strip() and seconds.strip():
+            overrides[pin.strip()] = int(seconds)
+    return overrides
+
+def parse_log_levels(value: str) -> Dict[str, str]:
+    """Parse "category=LEVEL,category=LEVEL" into {category: LEVEL}."""
+    levels = {}
+    for item in value.split(","):
+        category, _, level = item.partition("=")
+        if category.strip() and level.strip():
+            levels[category.strip()] = level.strip().upper()
+    return levels
+
 def parse_mqtt_url(url: str) -> Dict[str, int | str]:
     parsed = urlparse(url if "://" in url else f"mqtt://{url}")
     host = parsed.hostname or "localhost"
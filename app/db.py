@@ -1,89 +1,259 @@
-import sqlite3
-from .config import SQLITE_DB_PATH
+from .cache import TTLCache
+from .config import DEVICE_SEQ_WINDOW, OWNERSHIP_CACHE_SIZE, OWNERSHIP_CACHE_TTL_SECONDS
+from .metrics import Counter, timed
+from .pool import DB_CALL_SECONDS, local_writes_blocked, reader, writer
+from .registry import DeviceState, registry
+from .rollups import record_rollups
+from .schema import migrate
 
 
 DEFAULT_DEVICE_MODE = "increment"
 VALID_DEVICE_MODES = {"increment", "decrement"}
+# Older SQLite builds allow 999 host parameters per statement.
+PINS_PER_QUERY = 500
+# Device seqs are uint32 and wrap around.
+SEQ_MODULUS = 1 << 32
 
+# (user_id, pin) -> bool; invalidated by link_pin_to_user / unlink_pin_from_user
+ownership_cache = TTLCache(OWNERSHIP_CACHE_SIZE, OWNERSHIP_CACHE_TTL_SECONDS, name="ownership")
 
-def connect():
-    conn = sqlite3.connect(SQLITE_DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+COUNT_REPLAYS = Counter("count_replays_dropped_total", "Count messages dropped as redeliveries of an applied device seq")
 
 
 def init_db() -> None:
-    with connect() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL UNIQUE,
-                password TEXT NOT NULL,
-                rfid_uid TEXT
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS devices (
-                pin TEXT PRIMARY KEY,
-                enabled BOOLEAN NOT NULL DEFAULT 1,
-                current_count INTEGER NOT NULL DEFAULT 0,
-                mode TEXT NOT NULL DEFAULT 'increment'
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_devices (
-                user_id INTEGER NOT NULL,
-                pin TEXT NOT NULL,
-                UNIQUE(user_id, pin)
-            )
-            """
-        )
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                pin TEXT NOT NULL,
-                change INTEGER NOT NULL,
-                new_count INTEGER NOT NULL,
-                ts INTEGER NOT NULL
-            )
+    with writer() as conn:
+        migrate(conn)
+    load_device_registry()
+
+
+def normalize_mode(mode) -> str:
+    return mode if mode in VALID_DEVICE_MODES else DEFAULT_DEVICE_MODE
+
+
+def device_state(r) -> DeviceState:
+    return DeviceState(
+        r["pin"],
+        normalize_mode(r["mode"]),
+        bool(r["enabled"]),
+        int(r["current_count"]),
+        int(r["version"]),
+        r["last_seq"],
+        r["last_boot"],
+    )
+
+
+def load_device_registry() -> None:
+    with reader() as conn:
+        devices = [device_state(r) for r in conn.execute("SELECT pin, enabled, current_count, mode, version, last_seq, last_boot FROM devices")]
+        links = [tuple(r) for r in conn.execute("SELECT user_id, pin, version FROM user_devices")]
+        removals = [tuple(r) for r in conn.execute("SELECT user_id, pin, version FROM device_removals")]
+        disabled_users = [r["id"] for r in conn.execute("SELECT id FROM users WHERE NOT enabled")]
+        badges = [tuple(r) for r in conn.execute("SELECT uid, user_id FROM rfid_badges")]
+    registry.replace(devices, links, removals, disabled_users, badges)
+
+
+def reload_devices(pins) -> None:
+    """
+    Re-read the given pins (and their owners' enabled flags) into the
+    registry after another process changed them. Read and applied with this
+    process's writes held off: a local write committed in between would
+    otherwise be overwritten by the older snapshot (an older last_seq lets a
+    redelivery count twice). Other processes' writes need no such care;
+    they are reloaded again when their own invalidation arrives.
+    """
+    pins = list(pins)
+    with reader() as conn, local_writes_blocked():
+        devices = [device_state(r) for r in select_pins(conn, "SELECT pin, enabled, current_count, mode, version, last_seq, last_boot FROM devices WHERE pin IN ({pins})", pins)]
+        links = [tuple(r) for r in select_pins(conn, "SELECT user_id, pin, version FROM user_devices WHERE pin IN ({pins})", pins)]
+        owners = sorted({user_id for user_id, _, _ in links})
+        users = [tuple(r) for r in select_pins(conn, "SELECT id, enabled FROM users WHERE id IN ({pins})", owners)]
+        registry.refresh(pins, devices, links, users)
+
+
+def reload_badges(uids) -> None:
+    """reload_devices() for badges, with local writes held off for the same reason."""
+    uids = list(uids)
+    with reader() as conn, local_writes_blocked():
+        badges = [tuple(r) for r in select_pins(conn, "SELECT uid, user_id FROM rfid_badges WHERE uid IN ({pins})", uids)]
+        registry.refresh_badges(uids, badges)
+
+
+def next_version(conn) -> int:
+    """Claim the next sync_state version for the caller's write transaction."""
+    row = conn.execute("UPDATE sync_state SET version = version + 1 WHERE id = 1 RETURNING version").fetchall()[0]
+    return int(row[0])
+
+
+def select_pins(conn, sql: str, pins, *params) -> list:
+    """
+    Rows of `sql` for a list of pins: its "{pins}" placeholder is expanded
+    to at most PINS_PER_QUERY host parameters at a time, after `params`.
+    """
+    rows = []
+    for start in range(0, len(pins), PINS_PER_QUERY):
+        chunk = pins[start:start + PINS_PER_QUERY]
+        rows += conn.execute(sql.format(pins=",".join("?" * len(chunk))), (*params, *chunk)).fetchall()
+    return rows
+
+
+def ensure_device_row(conn, pin: str):
+    """Create the devices row for `pin` if needed and return (mode, enabled, count)."""
+    conn.execute(
+        "INSERT OR IGNORE INTO devices(pin, current_count, mode) VALUES (?, 0, ?)",
+        (pin, DEFAULT_DEVICE_MODE),
+    )
+    row = conn.execute(
+        "SELECT enabled, current_count, mode FROM devices WHERE pin = ?",
+        (pin,),
+    ).fetchone()
+    return normalize_mode(row["mode"]), bool(row["enabled"]), int(row["current_count"])
+
+
+def add_to_counters(conn, items):
+    """
+    Apply (pin, change, ts) items inside the caller's transaction and return
+    each item's new_count.
+
+    Each pin gets one atomic upsert that adds the summed change and returns
+    the final count, so there is no read-modify-write to race. Per-item
+    counts are then derived backwards from that final value, which yields
+    exactly the sequence of applying the items one by one. Returns
+    (new_counts, {pin: (mode, enabled, count, version)}).
+    """
+    version = next_version(conn)
+    totals = {}
+    for pin, change, _ in items:
+        totals[pin] = totals.get(pin, 0) + int(change)
+
+    final = {}
+    for pin, total in totals.items():
+        row = conn.execute(
             """
-        )
+            INSERT INTO devices(pin, current_count, mode, version) VALUES (?, ?, ?, ?)
+            ON CONFLICT(pin) DO UPDATE SET
+                current_count = current_count + excluded.current_count,
+                version = excluded.version
+            RETURNING current_count, enabled, mode
+            """,
+            (pin, total, DEFAULT_DEVICE_MODE, version),
+        ).fetchall()[0]
+        final[pin] = (normalize_mode(row["mode"]), bool(row["enabled"]), int(row["current_count"]), version)
+
+    remaining = {pin: state[2] for pin, state in final.items()}
+    new_counts = [0] * len(items)
+    for index in range(len(items) - 1, -1, -1):
+        pin, change, _ = items[index]
+        new_counts[index] = remaining[pin]
+        remaining[pin] -= int(change)
+
+    log_rows = [(pin, int(change), new_count, ts) for (pin, change, ts), new_count in zip(items, new_counts)]
+    conn.executemany(
+        "INSERT INTO logs(pin, change, new_count, ts) VALUES (?, ?, ?, ?)",
+        log_rows,
+    )
+    record_rollups(conn, log_rows)
+    return new_counts, final
+
+
+def apply_changes(items):
+    """Bulk apply_change: one transaction for many (pin, change, ts) tuples."""
+    items = list(items)
+    if not items:
+        return []
+    with writer() as conn:
+        new_counts, final = add_to_counters(conn, items)
         conn.commit()
+        for pin, state in final.items():
+            registry.put(pin, *state)
+    return new_counts
 
 
 def apply_change(pin: str, change: int, ts: int):
-    with connect() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO devices(pin, current_count, mode) VALUES (?, 0, ?)",
-            (pin, DEFAULT_DEVICE_MODE),
-        )
-        row = conn.execute(
-            "SELECT current_count FROM devices WHERE pin = ?",
-            (pin,),
-        ).fetchone()
-        current = int(row["current_count"]) if row else 0
-        new_count = current + int(change)
-        conn.execute(
-            "UPDATE devices SET current_count = ? WHERE pin = ?",
-            (new_count, pin),
-        )
-        conn.execute(
-            "INSERT INTO logs(pin, change, new_count, ts) VALUES (?, ?, ?, ?)",
-            (pin, int(change), new_count, ts),
-        )
+    return apply_changes([(pin, change, ts)])[0]
+
+
+def is_replay(last_seq, last_boot, seq, boot) -> bool:
+    """
+    Whether a count message with device seq `seq` and boot `boot` was
+    already applied, given the last seq and boot applied for its pin: true
+    for the same boot and the same seq or one up to DEVICE_SEQ_WINDOW behind
+    it (modulo 2**32). A different boot, or a seq further behind, means the
+    device started counting again and is accepted.
+    """
+    if seq is None or last_seq is None or boot != last_boot:
+        return False
+    return (last_seq - seq) % SEQ_MODULUS < DEVICE_SEQ_WINDOW
+
+
+def apply_count_events(messages):
+    """
+    Apply a batch of count messages, (pin, [(ts, n), ...], seq, boot), in a
+    single transaction.
+
+    Events are applied in order, each as one change of n (one log row), so
+    each pin gets the same new_count sequence as one apply_change call per
+    event. A message whose seq is a replay (see
+    is_replay) is dropped whole; the last seq and boot per pin are committed
+    with the counts, so a redelivery after a restart is still caught. Returns,
+    per message, one (change, new_count) tuple per event, or None for events
+    on disabled pins and in dropped messages.
+    """
+    changes = {}
+    last_seqs = {}
+    new_seqs = {}
+    items = []
+    positions = []
+    replays = 0
+    with writer() as conn:
+        for index, (pin, events, seq, boot) in enumerate(messages):
+            change = changes.get(pin)
+            if change is None:
+                state = registry.get(pin)
+                if state is None:
+                    mode, enabled, _ = ensure_device_row(conn, pin)
+                    last_seqs[pin] = tuple(conn.execute("SELECT last_seq, last_boot FROM devices WHERE pin = ?", (pin,)).fetchone())
+                else:
+                    mode, enabled = state.mode, registry.is_enabled(state)
+                    last_seqs[pin] = (state.last_seq, state.last_boot)
+                change = (1 if mode == "increment" else -1) if enabled else 0
+                changes[pin] = change
+            if seq is not None:
+                if is_replay(*last_seqs[pin], seq, boot):
+                    replays += 1
+                    continue
+                last_seqs[pin] = new_seqs[pin] = (seq, boot)
+            if change:
+                for position, (ts, n) in enumerate(events):
+                    items.append((pin, change * n, ts))
+                    positions.append((index, position))
+
+        new_counts, final = add_to_counters(conn, items) if items else ([], {})
+        if new_seqs:
+            conn.executemany(
+                "UPDATE devices SET last_seq = ?, last_boot = ? WHERE pin = ?",
+                [(seq, boot, pin) for pin, (seq, boot) in new_seqs.items()],
+            )
         conn.commit()
-        return new_count
+        for pin, state in final.items():
+            registry.put(pin, *state)
+        if new_seqs:
+            registry.set_last_seqs(new_seqs)
+
+    if replays:
+        COUNT_REPLAYS.inc(replays)
+    results = [[None] * len(events) for _, events, _, _ in messages]
+    for (index, position), (_, change, _), new_count in zip(positions, items, new_counts):
+        results[index][position] = (change, new_count)
+    return results
 
 
 def get_current_count(pin: str):
-    with connect() as conn:
+    state = registry.get(pin)
+    if state is not None:
+        return state.count
+    if registry.loaded:
+        return 0
+    with reader() as conn:
         row = conn.execute(
             "SELECT current_count FROM devices WHERE pin = ?",
             (pin,),
@@ -93,21 +263,62 @@ def get_current_count(pin: str):
         return int(row["current_count"])
 
 
-def get_logs(pin: str, limit: int = 50):
+def log_filters(pin: str, before=None, after=None, since=None, until=None):
+    clauses = ["pin = ?"]
+    params = [pin]
+    for clause, value in (("id < ?", before), ("id > ?", after), ("ts >= ?", since), ("ts <= ?", until)):
+        if value is not None:
+            clauses.append(clause)
+            params.append(int(value))
+    return " AND ".join(clauses), params
+
+
+def log_row(r) -> dict:
+    return {"id": r["id"], "pin": r["pin"], "change": r["change"], "new_count": r["new_count"], "ts": r["ts"]}
+
+
+def get_logs(pin: str, limit: int = 50, before=None, after=None, since=None, until=None):
+    """
+    One page of a pin's logs, keyset-paginated on logs.id. Newest first by
+    default and with `before`; oldest first with `after`.
+    """
     limit = max(1, min(500, int(limit)))
-    with connect() as conn:
+    where, params = log_filters(pin, before=before, after=after, since=since, until=until)
+    order = "ASC" if after is not None and before is None else "DESC"
+    with reader() as conn:
         rows = conn.execute(
-            "SELECT pin, change, new_count, ts FROM logs WHERE pin = ? ORDER BY id DESC LIMIT ?",
-            (pin, limit),
+            f"SELECT id, pin, change, new_count, ts FROM logs WHERE {where} ORDER BY id {order} LIMIT ?",
+            (*params, limit),
         ).fetchall()
-        return [
-            {"pin": r["pin"], "change": r["change"], "new_count": r["new_count"], "ts": r["ts"]}
-            for r in rows
-        ]
+        return [log_row(r) for r in rows]
+
+
+def iter_log_chunks(pin: str, since=None, until=None, chunk_size: int = 1000):
+    """
+    Yield a pin's logs oldest first, in lists of up to `chunk_size` rows.
+    Each chunk is its own short read keyed on the last id seen, so a long
+    export neither pins a pooled connection nor holds a read snapshot open.
+    """
+    after = None
+    # Iterated by the response stream rather than run_db, so timed here.
+    histogram = DB_CALL_SECONDS.labels("iter_log_chunks")
+    while True:
+        where, params = log_filters(pin, after=after, since=since, until=until)
+        with timed(histogram), reader() as conn:
+            rows = conn.execute(
+                f"SELECT id, pin, change, new_count, ts FROM logs WHERE {where} ORDER BY id ASC LIMIT ?",
+                (*params, chunk_size),
+            ).fetchall()
+        if not rows:
+            return
+        yield [log_row(r) for r in rows]
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1]["id"]
 
 
 def create_user(username: str, password: str) -> int:
-    with connect() as conn:
+    with writer() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO users(username, password) VALUES (?, ?)",
@@ -117,40 +328,26 @@ def create_user(username: str, password: str) -> int:
         return int(cursor.lastrowid)
 
 
-def set_user_pins_enabled(pin: str, enabled: bool):
+def toggle_user_enabled(user_id: int):
     """
-    Trouve l'utilisateur associé au 'pin' fourni et active/désactive 
-    TOUS les appareils de cet utilisateur.
+    Flip the user's enabled flag: one indexed write however many devices the
+    user has. Returns (enabled, [(pin, enabled as the pin now shows), ...])
+    for the user's devices, or None if there is no such user.
     """
-    val = 1 if enabled else 0
-    with connect() as conn:
-        conn.execute(
-            """
-            UPDATE devices
-            SET enabled = ?
-            WHERE pin IN (
-                SELECT target.pin 
-                FROM user_devices AS target
-                JOIN user_devices AS source ON target.user_id = source.user_id
-                WHERE source.pin = ?
-            )
-            """,
-            (val, pin),
-        )
-        conn.commit()
-
-def get_pin_by_id(pin: str):
-    with connect() as conn:
+    with writer() as conn:
+        version = next_version(conn)
         row = conn.execute(
-            "SELECT pin, enabled, current_count FROM devices WHERE pin = ?",
-            (pin,),
-        ).fetchone()
+            "UPDATE users SET enabled = NOT enabled, enabled_version = ? WHERE id = ? RETURNING enabled",
+            (version, user_id),
+        ).fetchall()
         if not row:
             return None
-        return {"pin": row["pin"], "enabled": bool(row["enabled"]), "current_count": row["current_count"]}
+        enabled = bool(row[0]["enabled"])
+        conn.commit()
+        return enabled, registry.set_user_enabled(user_id, enabled, version)
 
 def get_user_by_username(username: str):
-    with connect() as conn:
+    with reader() as conn:
         row = conn.execute(
             "SELECT id, username, password FROM users WHERE username = ?",
             (username,),
@@ -159,139 +356,267 @@ def get_user_by_username(username: str):
             return None
         return {"id": row["id"], "username": row["username"], "password": row["password"]}
     
-def get_user_by_device_pin(pin: str):
-    with connect() as conn:
-        row = conn.execute(
-            """
-            SELECT u.id, u.username, u.rfid_uid
-            FROM users u
-            JOIN user_devices ud ON u.id = ud.user_id
-            WHERE ud.pin = ?
-            """,
-            (pin,),
-        ).fetchone()
-        if not row:
-            return None
-        return {"id": row["id"], "username": row["username"], "rfid_uid": row["rfid_uid"]}
-
+def set_user_password(user_id: int, old_password: str, new_password: str) -> bool:
+    """Swap in a rehashed password, unless it was changed in the meantime."""
+    with writer() as conn:
+        cursor = conn.execute(
+            "UPDATE users SET password = ? WHERE id = ? AND password = ?",
+            (new_password, user_id, old_password),
+        )
+        conn.commit()
+        return cursor.rowcount > 0
 
-def set_user_rfid(user_id: int, rfid_uid: str) -> None:
-    with connect() as conn:
-        conn.execute(
-            "UPDATE users SET rfid_uid = ? WHERE id = ?",
-            (rfid_uid, user_id),
+def set_user_badges(user_id: int, uids) -> list:
+    """
+    Make `uids` the user's RFID badges. Returns the ones another user already
+    holds, in which case nothing is changed.
+    """
+    uids = list(dict.fromkeys(uids))
+    with writer() as conn:
+        taken = [
+            r["uid"]
+            for r in select_pins(conn, "SELECT uid FROM rfid_badges WHERE user_id != ? AND uid IN ({pins})", uids, user_id)
+        ]
+        if taken:
+            return sorted(taken)
+        conn.execute("DELETE FROM rfid_badges WHERE user_id = ?", (user_id,))
+        conn.executemany(
+            "INSERT INTO rfid_badges(uid, user_id) VALUES (?, ?)",
+            [(uid, user_id) for uid in uids],
         )
         conn.commit()
+        registry.set_badges(user_id, uids)
+    return []
 
 
-def get_user_rfid(user_id: int):
-    with connect() as conn:
-        row = conn.execute(
-            "SELECT rfid_uid FROM users WHERE id = ?",
-            (user_id,),
-        ).fetchone()
-        if not row:
-            return None
-        return row["rfid_uid"]
+def set_user_rfid(user_id: int, rfid_uid: str) -> list:
+    return set_user_badges(user_id, [rfid_uid])
+
+
+def get_user_badges(user_id: int) -> list:
+    if registry.loaded and not registry.shared:
+        return registry.badges_of(user_id)
+    with reader() as conn:
+        return [r["uid"] for r in conn.execute("SELECT uid FROM rfid_badges WHERE user_id = ? ORDER BY uid", (user_id,))]
 
 
 def link_pin_to_user(user_id: int, pin: str) -> None:
-    with connect() as conn:
-        conn.execute(
+    link_pins_to_user(user_id, [pin])
+
+
+def link_pins_to_user(user_id: int, pins) -> dict:
+    """
+    Link many pins to a user in one transaction, creating their device rows
+    as needed. Returns {pin: "linked" | "already_linked"}.
+    """
+    pins = list(dict.fromkeys(pins))
+    with writer() as conn:
+        conn.executemany(
             "INSERT OR IGNORE INTO devices(pin, current_count, mode) VALUES (?, 0, ?)",
-            (pin, DEFAULT_DEVICE_MODE),
-        )
-        conn.execute(
-            "INSERT OR IGNORE INTO user_devices(user_id, pin) VALUES (?, ?)",
-            (user_id, pin),
+            [(pin, DEFAULT_DEVICE_MODE) for pin in pins],
         )
+        linked = {r["pin"] for r in select_pins(conn, "SELECT pin FROM user_devices WHERE user_id = ? AND pin IN ({pins})", pins, user_id)}
+        new = [pin for pin in pins if pin not in linked]
+        if new:
+            version = next_version(conn)
+            conn.executemany(
+                "INSERT INTO user_devices(user_id, pin, version) VALUES (?, ?, ?)",
+                [(user_id, pin, version) for pin in new],
+            )
+            conn.executemany(
+                "DELETE FROM device_removals WHERE user_id = ? AND pin = ?",
+                [(user_id, pin) for pin in new],
+            )
+            rows = select_pins(conn, "SELECT pin, enabled, current_count, mode FROM devices WHERE pin IN ({pins})", new)
         conn.commit()
+        if new:
+            registry.put_many((r["pin"], normalize_mode(r["mode"]), bool(r["enabled"]), int(r["current_count"])) for r in rows)
+            registry.add_owner(user_id, new, version)
+            for pin in new:
+                ownership_cache.pop((user_id, pin))
+    return {pin: "already_linked" if pin in linked else "linked" for pin in pins}
 
 
 def unlink_pin_from_user(user_id: int, pin: str) -> bool:
     """Detach a pin from a user and clean up orphaned device data."""
-    with connect() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "DELETE FROM user_devices WHERE user_id = ? AND pin = ?",
-            (user_id, pin),
-        )
-        deleted = cursor.rowcount > 0
-        if not deleted:
-            conn.commit()
-            return False
+    return unlink_pins_from_user(user_id, [pin])[pin] == "unlinked"
 
-        still_linked = cursor.execute(
-            "SELECT 1 FROM user_devices WHERE pin = ? LIMIT 1",
-            (pin,),
-        ).fetchone()
-        if not still_linked:
-            cursor.execute("DELETE FROM devices WHERE pin = ?", (pin,))
-            cursor.execute("DELETE FROM logs WHERE pin = ?", (pin,))
 
+def unlink_pins_from_user(user_id: int, pins) -> dict:
+    """
+    Detach many pins from a user in one transaction; devices no other user
+    links lose their counters, logs and rollups. Returns
+    {pin: "unlinked" | "not_found"}.
+    """
+    pins = list(dict.fromkeys(pins))
+    with writer() as conn:
+        linked = {r["pin"] for r in select_pins(conn, "SELECT pin FROM user_devices WHERE user_id = ? AND pin IN ({pins})", pins, user_id)}
+        removed = [pin for pin in pins if pin in linked]
+        orphans = []
+        if removed:
+            version = next_version(conn)
+            conn.executemany(
+                "DELETE FROM user_devices WHERE user_id = ? AND pin = ?",
+                [(user_id, pin) for pin in removed],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO device_removals(user_id, pin, version) VALUES (?, ?, ?)",
+                [(user_id, pin, version) for pin in removed],
+            )
+            still_linked = {r["pin"] for r in select_pins(conn, "SELECT DISTINCT pin FROM user_devices WHERE pin IN ({pins})", removed)}
+            orphans = [pin for pin in removed if pin not in still_linked]
+            for table in ("devices", "logs", "log_rollups"):
+                conn.executemany(f"DELETE FROM {table} WHERE pin = ?", [(pin,) for pin in orphans])
         conn.commit()
-        return True
+        if removed:
+            for pin in removed:
+                ownership_cache.pop((user_id, pin))
+            registry.remove_owner(user_id, removed, version)
+            registry.remove(orphans)
+    return {pin: "unlinked" if pin in linked else "not_found" for pin in pins}
+
+
+def set_user_devices_mode(user_id: int, pins, mode: str) -> dict:
+    """
+    Set the counting mode of many of a user's pins in one transaction.
+    Returns {pin: "updated" | "forbidden"}; raises ValueError for a bad mode.
+    """
+    normalized = parse_device_mode(mode)
+    return _update_user_devices(user_id, pins, "mode", normalized, lambda targets, version: registry.set_mode(targets, normalized, version))
+
+
+def set_user_devices_enabled(user_id: int, pins, enabled: bool) -> dict:
+    """Enable or disable many of a user's pins in one transaction; same results as set_user_devices_mode."""
+    return _update_user_devices(user_id, pins, "enabled", int(bool(enabled)), lambda targets, version: registry.set_enabled(targets, bool(enabled), version))
+
+
+def _update_user_devices(user_id: int, pins, column: str, value, update_registry) -> dict:
+    pins = list(dict.fromkeys(pins))
+    with writer() as conn:
+        owned = {r["pin"] for r in select_pins(conn, "SELECT pin FROM user_devices WHERE user_id = ? AND pin IN ({pins})", pins, user_id)}
+        targets = [pin for pin in pins if pin in owned]
+        if targets:
+            version = next_version(conn)
+            conn.executemany(
+                f"UPDATE devices SET {column} = ?, version = ? WHERE pin = ?",
+                [(value, version, pin) for pin in targets],
+            )
+        conn.commit()
+        if targets:
+            update_registry(targets, version)
+    return {pin: "updated" if pin in owned else "forbidden" for pin in pins}
+
+
+def owned_pins(user_id: int, pins) -> set:
+    """The subset of `pins` linked to the user."""
+    with reader() as conn:
+        return {r["pin"] for r in select_pins(conn, "SELECT pin FROM user_devices WHERE user_id = ? AND pin IN ({pins})", list(pins), user_id)}
+
+
+def device_record(pin, count, enabled, mode) -> dict:
+    return {"pin": pin, "current_count": count, "enabled": int(enabled), "mode": mode}
+
+
+def get_user_devices(user_id: int, since=None):
+    """
+    (version, devices, removed pins) for a user's dashboard: the full list,
+    or with `since` only what changed after that version. A `since` that is
+    not a version this user could have seen falls back to the full list;
+    callers can tell from `full`.
+    """
+    if registry.loaded and not registry.shared:
+        version = registry.user_version(user_id)
+        full = since is None or not 0 < since <= version
+        version, rows, removed = registry.user_devices(user_id, None if full else since)
+    else:
+        # Other processes write too, so their changes may not have reached our
+        # registry yet; read one consistent snapshot from the database.
+        with reader() as conn:
+            rows = conn.execute(
+                """
+                SELECT d.pin, d.current_count, d.enabled AND o.enabled AS enabled, d.mode,
+                       MAX(d.version, ud.version, o.version) AS version, 0 AS removed
+                FROM user_devices ud
+                JOIN devices d ON d.pin = ud.pin
+                JOIN (
+                    -- Every owner's flag gates the pin, and flipping it changes the pin.
+                    SELECT od.pin, MIN(u.enabled) AS enabled, MAX(u.enabled_version) AS version
+                    FROM user_devices od
+                    JOIN users u ON u.id = od.user_id
+                    WHERE od.pin IN (SELECT pin FROM user_devices WHERE user_id = ?)
+                    GROUP BY od.pin
+                ) AS o ON o.pin = ud.pin
+                WHERE ud.user_id = ?
+                UNION ALL
+                SELECT pin, NULL, NULL, NULL, version, 1 FROM device_removals WHERE user_id = ?
+                """,
+                (user_id, user_id, user_id),
+            ).fetchall()
+        version = max((r["version"] for r in rows), default=0)
+        full = since is None or not 0 < since <= version
+        removed = sorted(r["pin"] for r in rows if r["removed"] and not full and r["version"] > since)
+        rows = sorted(
+            (r["pin"], r["current_count"], bool(r["enabled"]), normalize_mode(r["mode"]))
+            for r in rows
+            if not r["removed"] and (full or r["version"] > since)
+        )
+    return {
+        "version": version,
+        "full": full,
+        "devices": [device_record(*row) for row in rows],
+        "removed": removed,
+    }
 
 
 def list_user_pins(user_id: int):
-    with connect() as conn:
-        rows = conn.execute(
-            """
-            SELECT d.pin, d.current_count, d.enabled, d.mode
-            FROM devices d
-            JOIN user_devices ud ON ud.pin = d.pin
-            WHERE ud.user_id = ?
-            ORDER BY d.pin
-            """,
-            (user_id,),
-        ).fetchall()
-        return [{"pin": r["pin"], "current_count": r["current_count"], "enabled": r["enabled"], "mode": r["mode" or DEFAULT_DEVICE_MODE]} for r in rows]
+    return get_user_devices(user_id)["devices"]
+
+
+def get_user_version(user_id: int) -> int:
+    if registry.loaded and not registry.shared:
+        return registry.user_version(user_id)
+    return get_user_devices(user_id)["version"]
 
 
 def is_pin_owned_by_user(user_id: int, pin: str) -> bool:
-    with connect() as conn:
+    key = (user_id, pin)
+    owned = ownership_cache.get(key)
+    if owned is not None:
+        return owned
+    generation = ownership_cache.generation
+    with reader() as conn:
         row = conn.execute(
             "SELECT 1 FROM user_devices WHERE user_id = ? AND pin = ?",
             (user_id, pin),
         ).fetchone()
-        return bool(row)
+    owned = bool(row)
+    ownership_cache.set(key, owned, generation)
+    return owned
 
 
-def get_device_mode(pin: str) -> str:
-    with connect() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO devices(pin, current_count, mode) VALUES (?, 0, ?)",
-            (pin, DEFAULT_DEVICE_MODE),
-        )
-        row = conn.execute(
-            "SELECT mode FROM devices WHERE pin = ?",
-            (pin,),
-        ).fetchone()
-        mode = (row["mode"] if row else None) or DEFAULT_DEVICE_MODE
-        if mode not in VALID_DEVICE_MODES:
-            mode = DEFAULT_DEVICE_MODE
-            conn.execute(
-                "UPDATE devices SET mode = ? WHERE pin = ?",
-                (mode, pin),
-            )
-        conn.commit()
-        return mode
-
-
-def set_device_mode(pin: str, mode: str) -> str:
+def parse_device_mode(mode) -> str:
     if not mode:
         raise ValueError("mode required")
     normalized = mode.strip().lower()
     if normalized not in VALID_DEVICE_MODES:
         raise ValueError("invalid mode")
-    with connect() as conn:
-        conn.execute(
-            "INSERT OR IGNORE INTO devices(pin, current_count, mode) VALUES (?, 0, ?)",
-            (pin, DEFAULT_DEVICE_MODE),
-        )
+    return normalized
+
+
+def set_device_mode(pin: str, mode: str) -> str:
+    normalized = parse_device_mode(mode)
+    with writer() as conn:
+        state = registry.get(pin)
+        if state is None:
+            _, enabled, count = ensure_device_row(conn, pin)
+        version = next_version(conn)
         conn.execute(
-            "UPDATE devices SET mode = ? WHERE pin = ?",
-            (normalized, pin),
+            "UPDATE devices SET mode = ?, version = ? WHERE pin = ?",
+            (normalized, version, pin),
         )
         conn.commit()
+        if state is None:
+            registry.put(pin, normalized, enabled, count, version)
+        else:
+            registry.set_mode((pin,), normalized, version)
         return normalized
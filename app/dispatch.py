@@ -0,0 +1,65 @@
+import asyncio
+import logging
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+class ShardedDispatcher:
+    """
+    Routes work items to one of N worker tasks by hashing their pin. Items
+    for the same pin always land on the same shard, so they are handled in
+    order, while unrelated pins proceed in parallel. submit() waits when the
+    target shard's queue is full, pushing back on the producer.
+    """
+
+    def __init__(self, handler, shards: int, queue_size: int):
+        self.handler = handler
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(max(1, shards))]
+        self.processed = [0] * len(self.queues)
+        self.tasks = []
+
+    def shard_for(self, pin: str) -> int:
+        return zlib.crc32(pin.encode("utf-8")) % len(self.queues)
+
+    async def submit(self, pin: str, *args) -> None:
+        await self.queues[self.shard_for(pin)].put((pin, *args))
+
+    def start(self) -> None:
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._run(index)) for index in range(len(self.queues))]
+
+    async def stop(self, drain_seconds: float = 0) -> None:
+        """
+        Stop the shards once they have handled what is already queued, or
+        after `drain_seconds`, whichever comes first. Submitting must have
+        stopped.
+        """
+        if self.tasks and drain_seconds > 0:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), drain_seconds)
+            except asyncio.TimeoutError:
+                left = sum(queue.qsize() for queue in self.queues)
+                log.warning("dropped %d queued messages after %.1fs", left, drain_seconds, extra={"dropped": left})
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _run(self, index: int) -> None:
+        queue = self.queues[index]
+        while True:
+            item = await queue.get()
+            try:
+                await self.handler(*item)
+            except Exception:
+                log.exception("shard %d handler failed", index)
+            finally:
+                queue.task_done()
+            self.processed[index] += 1
+
+    def stats(self):
+        return [
+            {"shard": index, "depth": queue.qsize(), "processed": self.processed[index]}
+            for index, queue in enumerate(self.queues)
+        ]
@@ -0,0 +1,30 @@
+import csv
+import io
+import json
+from .config import LOG_EXPORT_CHUNK_SIZE
+from .db import iter_log_chunks
+
+LOG_FIELDS = ["id", "pin", "change", "new_count", "ts"]
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def export_ndjson(pin: str, since=None, until=None):
+    for chunk in iter_log_chunks(pin, since=since, until=until, chunk_size=LOG_EXPORT_CHUNK_SIZE):
+        yield "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in chunk)
+
+
+def export_csv(pin: str, since=None, until=None):
+    yield ",".join(LOG_FIELDS) + "\r\n"
+    for chunk in iter_log_chunks(pin, since=since, until=until, chunk_size=LOG_EXPORT_CHUNK_SIZE):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=LOG_FIELDS)
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+
+
+def export_logs(pin: str, fmt: str, since=None, until=None):
+    if fmt == "ndjson":
+        return export_ndjson(pin, since=since, until=until)
+    if fmt == "csv":
+        return export_csv(pin, since=since, until=until)
+    raise ValueError("invalid format")
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+from .config import INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_MS
+from .db import apply_count_events
+from .logsetup import PinSampler
+from .metrics import Gauge
+from .pool import run_db
+from .ws import broadcast_many
+
+log = logging.getLogger(__name__)
+pin_log = PinSampler(log)
+
+_queue = None
+# Count messages queued so far, and how many of them have been written (the
+# worker takes them in queue order).
+_submitted = 0
+_written = 0
+_progress = None
+
+
+def get_queue() -> asyncio.Queue:
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    return _queue
+
+
+def get_progress() -> asyncio.Condition:
+    global _progress
+    if _progress is None:
+        _progress = asyncio.Condition()
+    return _progress
+
+
+Gauge("ingest_queue_depth", "Count messages waiting for the batcher", lambda: _queue.qsize() if _queue is not None else 0)
+
+
+async def submit_counts(pin: str, topic: str, events, seq=None, boot=None) -> None:
+    """
+    Queue one count message: its events as (ts, n) pairs, in order, and the
+    device seq and boot if it has them. Waits when the queue is full
+    (backpressure).
+    """
+    global _submitted
+    await get_queue().put((pin, topic, events, seq, boot))
+    _submitted += 1
+
+
+async def wait_written() -> None:
+    """
+    Wait until every count message queued before this call is written and
+    broadcast, so a toggle lands after the counts that arrived before it
+    (at most about INGEST_FLUSH_MS plus one write, when any are queued).
+    """
+    target = _submitted
+    if _written >= target:
+        return
+    progress = get_progress()
+    async with progress:
+        await progress.wait_for(lambda: _written >= target)
+
+
+async def collect_batch(queue: asyncio.Queue, batch: list) -> None:
+    # A batch closes at INGEST_BATCH_SIZE events, however they are split
+    # into messages.
+    loop = asyncio.get_running_loop()
+    batch.append(await queue.get())
+    events = len(batch[-1][2])
+    deadline = loop.time() + INGEST_FLUSH_MS / 1000
+    while events < INGEST_BATCH_SIZE:
+        try:
+            batch.append(queue.get_nowait())
+            events += len(batch[-1][2])
+            continue
+        except asyncio.QueueEmpty:
+            pass
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(queue.get(), timeout))
+            events += len(batch[-1][2])
+        except asyncio.TimeoutError:
+            break
+
+
+def count_messages(batch) -> list:
+    return [(pin, events, seq, boot) for pin, _, events, seq, boot in batch]
+
+
+async def flush(batch) -> None:
+    global _written
+    try:
+        await write(batch)
+    finally:
+        _written += len(batch)
+        progress = get_progress()
+        async with progress:
+            progress.notify_all()
+
+
+async def write(batch) -> None:
+    try:
+        results = await run_db(apply_count_events, count_messages(batch))
+    except Exception:
+        dropped = sum(n for _, _, events, _, _ in batch for _, n in events)
+        log.exception("dropped %d count events", dropped, extra={"dropped": dropped})
+        return
+
+    msgs = []
+    for (pin, topic, events, _, _), applied in zip(batch, results):
+        for (ts, _), result in zip(events, applied):
+            if result is None:
+                continue
+            change, new_count = result
+            pin_log.debug(pin, "pin %s change %+d -> %d", pin, change, new_count, change=change, new_count=new_count)
+            msgs.append(
+                {
+                    "topic": topic,
+                    "pin": pin,
+                    "change": change,
+                    "new_count": new_count,
+                    "ts": ts,
+                }
+            )
+    await broadcast_many(msgs)
+
+
+async def ingest_worker():
+    queue = get_queue()
+    pending = []
+    flushing = None
+    try:
+        while True:
+            await collect_batch(queue, pending)
+            batch, pending = pending, []
+            # Shielded: a cancelled run_db could drop a batch the DB thread
+            # had not started on yet.
+            flushing = asyncio.ensure_future(flush(batch))
+            await asyncio.shield(flushing)
+    except asyncio.CancelledError:
+        # Finish the batch in flight, then persist whatever was still queued
+        # so a shutdown does not lose counts.
+        if flushing is not None and not flushing.done():
+            await flushing
+        while not queue.empty():
+            pending.append(queue.get_nowait())
+        if pending:
+            apply_count_events(count_messages(pending))
+        raise
@@ -0,0 +1,123 @@
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from .config import LOG_FORMAT, LOG_LEVEL, LOG_LEVELS, LOG_PIN_INTERVAL_SECONDS, LOG_PIN_MAX, parse_log_levels
+
+# Every module logs to a child of this one (app.mqtt, app.ingest, ...); the
+# part after "app." is the category LOG_LEVELS refers to.
+ROOT = "app"
+
+# Attributes every LogRecord has; anything else on a record came from `extra`.
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, then the record's extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+def make_formatter(fmt: str) -> logging.Formatter:
+    if fmt == "text":
+        return logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+    return JsonFormatter()
+
+
+class _StructuredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock prepare() folds the traceback into msg; keep it apart as
+        # exc_text for the formatter's "exc" field. Either way the queued
+        # record holds no live frames.
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging() -> None:
+    """
+    Route the app's loggers through a queue to a background thread that does
+    the formatting and the writing, so a log call on the event loop costs an
+    enqueue. Safe to call more than once.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    root = logging.getLogger(ROOT)
+    root.setLevel(LOG_LEVEL.upper())
+    for category, level in parse_log_levels(LOG_LEVELS).items():
+        logging.getLogger(f"{ROOT}.{category}").setLevel(level.upper())
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(make_formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    root.addHandler(_StructuredQueueHandler(records))
+    root.propagate = False
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging() -> None:
+    """Flush what is queued and stop the writer thread."""
+    global _listener
+    listener, _listener = _listener, None
+    if listener is None:
+        return
+    listener.stop()
+    root = logging.getLogger(ROOT)
+    for handler in list(root.handlers):
+        if isinstance(handler, _StructuredQueueHandler):
+            root.removeHandler(handler)
+    root.propagate = True
+
+
+class PinSampler:
+    """
+    Debug logs about individual pins, at most one per pin every `interval`
+    seconds. Records skipped in between are counted and reported as
+    `suppressed` on the next one that goes out, so the log volume follows
+    the number of pins, not the message rate. Only call from the event loop.
+    """
+
+    def __init__(self, logger: logging.Logger, interval: float = LOG_PIN_INTERVAL_SECONDS, max_pins: int = LOG_PIN_MAX):
+        self.logger = logger
+        self.interval = interval
+        self.max_pins = max(1, max_pins)
+        # pin -> [next allowed time, suppressed since the last record]
+        self._pins = {}
+
+    def debug(self, pin: str, msg: str, *args, **fields) -> None:
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        now = time.monotonic()
+        entry = self._pins.get(pin)
+        if entry is not None and now < entry[0]:
+            entry[1] += 1
+            return
+        suppressed = entry[1] if entry is not None else 0
+        if entry is None and len(self._pins) >= self.max_pins:
+            # Topics come from the network; start over rather than grow.
+            self._pins.clear()
+        self._pins[pin] = [now + self.interval, 0]
+        self.logger.debug(msg, *args, extra={"pin": pin, "suppressed": suppressed, **fields})
@@ -0,0 +1,202 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+
+# Seconds; from sub-millisecond registry hits to multi-second stalls.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# How often loop_lag_monitor asks to be woken up.
+LOOP_LAG_INTERVAL = 0.1
+
+_metrics = []
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Exported(ABC):
+    """Anything render() lists: a name, help text and its exposition lines."""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        _metrics.append(self)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def render(self) -> list:
+        ...
+
+
+class _Metric(_Exported):
+    """A metric that keeps its own values, one child per label combination."""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self._children = {}
+        super().__init__(name, help, labels)
+
+    def labels(self, *values):
+        """The child for one label combination; callers on hot paths keep it."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        ...
+
+    def render(self) -> list:
+        lines = self.header()
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1) -> None:
+        # No lock: a rare lost increment between threads is an accepted cost.
+        self.value += amount
+
+    def render(self, name, label_names, values):
+        return [f"{name}{_format_labels(label_names, values)} {self.value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        super().__init__(name, help, labels)
+        if not self.label_names:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1) -> None:
+        self._default.inc(amount)
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, label_names, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            labels = _format_labels(label_names + ("le",), values + (le,))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _format_labels(label_names, values)
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Fixed buckets, preallocated per label combination; observe() is a bisect and two adds."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        super().__init__(name, help, labels)
+        if not self.label_names:
+            self._default = self.labels()
+
+    def _new_child(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value: float) -> None:
+        self._default.observe(value)
+
+
+class Gauge(_Exported):
+    """
+    Read at scrape time from `collect()`, which returns a number or, for a
+    labelled gauge, a dict of label value tuples to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, collect, labels=()):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def render(self) -> list:
+        lines = self.header()
+        value = self.collect()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for values, number in sorted(items):
+            lines.append(f"{self.name}{_format_labels(self.label_names, values)} {number}")
+        return lines
+
+
+class CollectedCounter(Gauge):
+    """A Gauge for a running total some other object already keeps (e.g. cache hits)."""
+
+    kind = "counter"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+LOOP_LAG = Histogram("event_loop_lag_seconds", "Delay of a timer callback past its deadline")
+
+
+async def loop_lag_monitor() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+
+class timed:
+    """`with timed(histogram):` observes the block's duration in seconds."""
+
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
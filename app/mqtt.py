@@ -1,108 +1,231 @@
 import asyncio
 import json
+import logging
 import time
-from .config import BROKER_URL, BROKER_TOPIC, parse_mqtt_url
-from .db import apply_change, get_device_mode
-from .ws import broadcast
+from .codecs import PayloadError, codec_for
+from .config import (
+    BROKER_URL,
+    BROKER_TOPIC,
+    MQTT_OUTBOX_SIZE,
+    MQTT_COMMAND_QOS,
+    MQTT_ENQUEUE_TIMEOUT_SECONDS,
+    MQTT_PUBLISH_BATCH,
+    MQTT_RECONNECT_MIN_SECONDS,
+    MQTT_RECONNECT_MAX_SECONDS,
+    MQTT_SHARDS,
+    MQTT_SHARD_QUEUE_SIZE,
+    MQTT_SHARD_DRAIN_SECONDS,
+    parse_mqtt_url,
+)
+from .dispatch import ShardedDispatcher
+from .ingest import submit_counts, wait_written
+from .logsetup import PinSampler
+from .metrics import Counter, CollectedCounter, Gauge
+from .pool import run_db
+from .registry import registry
+from .ws import broadcast, broadcast_many
 import app.db as db
 
 import aiomqtt as mqtt
 
 Client = mqtt.Client
 
+log = logging.getLogger(__name__)
+pin_log = PinSampler(log)
 
-async def mqtt_consumer():
-    cfg = parse_mqtt_url(BROKER_URL)
-    while True:
-        try:
-            async with Client(cfg["host"], cfg["port"]) as client:
-                await client.subscribe(f"{BROKER_TOPIC}/+/+")
-                print("MQTT connected to", BROKER_URL, "subscribed to", f"{BROKER_TOPIC}/+/+")
+_outbox = None
 
-                async for message in client.messages:
-                    topic = message.topic
-                    ts = int(time.time())
 
-                    topicString = topic.value
-                    parts = topicString.split("/")
-                    print("new message", topicString)
+def get_outbox() -> asyncio.Queue:
+    global _outbox
+    if _outbox is None:
+        _outbox = asyncio.Queue(maxsize=MQTT_OUTBOX_SIZE)
+    return _outbox
 
-                    if len(parts) < 4:
-                        continue
 
-                    pin = parts[-2]
-                    action = parts[-1]
+async def handle_message(pin: str, action: str, raw_payload, topic: str, ts: int) -> None:
+    codec = codec_for(raw_payload)
+    MQTT_PAYLOADS.labels(codec.name).inc()
 
-                    try:
-                        payload = json.loads(message.payload.decode("utf-8"))
-                    except Exception:
-                        continue
+    if action == "count":
+        # Empty and {} bodies are one event and are never parsed; a batch is
+        # one change of n, or with ages one event per age, oldest first.
+        # Replays of a seq already applied are dropped when the batch is
+        # written.
+        try:
+            seq, boot, events = codec.count_events(raw_payload, ts)
+        except PayloadError as e:
+            MESSAGES_MALFORMED.inc()
+            pin_log.debug(pin, "pin %s bad %s count payload: %s", pin, codec.name, e, codec=codec.name)
+            return
+        await submit_counts(pin, topic, events, seq, boot)
+        return
+
+    if action == "toggle":
+        try:
+            payload = codec.decode(raw_payload)
+        except PayloadError:
+            MESSAGES_MALFORMED.inc()
+            return
+        uuid = str(payload.get("uuid", ""))
+        state = registry.get(pin)
+        if state is None or not state.owners:
+            return
+
+        # Badges live in the registry: authorizing a tap needs no query.
+        user_id = registry.badge_user(pin, uuid)
+        if user_id is None:
+            await broadcast(
+                {
+                    "topic": topic,
+                    "pin": pin,
+                    "enabled": False,
+                    "not_authorized": True,
+                    "uuid": uuid,
+                    "ts": ts,
+                }
+            )
+            return
+
+        # Counts that arrived before the tap are judged by the state before it.
+        await wait_written()
+        toggled = await run_db(db.toggle_user_enabled, user_id)
+        if toggled is None:
+            return
+        enabled, pins = toggled
+        pin_log.debug(pin, "pin %s toggled user %d enabled=%s", pin, user_id, enabled, enabled=enabled, devices=len(pins))
+        # Every pin of the user changed; one fan-out tells all their dashboards.
+        await broadcast_many(
+            [
+                {
+                    "topic": f"{BROKER_TOPIC}/{device_pin}/toggle",
+                    "pin": device_pin,
+                    "enabled": device_enabled,
+                    "uuid": uuid,
+                    "ts": ts,
+                }
+                for device_pin, device_enabled in pins
+            ]
+        )
+        return
+
+
+dispatcher = ShardedDispatcher(handle_message, MQTT_SHARDS, MQTT_SHARD_QUEUE_SIZE)
+
+MQTT_MESSAGES = Counter("mqtt_messages_total", "MQTT messages received, by topic action", labels=("action",))
+# Topics come from the network: only known actions get their own series.
+MESSAGES_BY_ACTION = {action: MQTT_MESSAGES.labels(action) for action in ("count", "toggle")}
+MESSAGES_OTHER = MQTT_MESSAGES.labels("other")
+MESSAGES_MALFORMED = MQTT_MESSAGES.labels("malformed")
+MQTT_PAYLOADS = Counter("mqtt_payloads_total", "MQTT payloads handled, by codec", labels=("codec",))
+
+Gauge(
+    "mqtt_shard_queue_depth",
+    "Messages waiting in each dispatcher shard",
+    lambda: {(str(shard["shard"]),): shard["depth"] for shard in dispatcher.stats()},
+    labels=("shard",),
+)
+CollectedCounter(
+    "mqtt_shard_processed_total",
+    "Messages handled by each dispatcher shard",
+    lambda: {(str(shard["shard"]),): shard["processed"] for shard in dispatcher.stats()},
+    labels=("shard",),
+)
 
-                    if action == "toggle":
-                        uuid = payload.get("uuid", "")
-                        user = db.get_user_by_device_pin(pin)
-                        if user is None:
-                            continue
 
-                        if user["rfid_uid"] != uuid:
-                            await broadcast(
-                                {
-                                    "topic": topic.value,
-                                    "pin": pin,
-                                    "enabled": False,
-                                    "not_authorized": True,
-                                    "uuid": uuid,
-                                    "ts": ts,
-                                }
-                            )
+async def mqtt_consumer():
+    cfg = parse_mqtt_url(BROKER_URL)
+    dispatcher.start()
+    try:
+        while True:
+            try:
+                async with Client(cfg["host"], cfg["port"]) as client:
+                    await client.subscribe(f"{BROKER_TOPIC}/+/+")
+                    log.info("connected to %s, subscribed to %s/+/+", BROKER_URL, BROKER_TOPIC)
+
+                    async for message in client.messages:
+                        ts = int(time.time())
+
+                        topicString = message.topic.value
+                        parts = topicString.split("/")
+
+                        if len(parts) < 4:
+                            MESSAGES_MALFORMED.inc()
                             continue
 
-                        pin_info = db.get_pin_by_id(pin)
-                        if pin_info is None:
-                            continue
+                        pin = parts[-2]
+                        action = parts[-1]
+                        MESSAGES_BY_ACTION.get(action, MESSAGES_OTHER).inc()
+                        await dispatcher.submit(pin, action, message.payload, topicString, ts)
+            except Exception as e:
+                log.warning("consumer error: %s", e)
+                await asyncio.sleep(3)
+    finally:
+        # The broker connection is closed by now, so nothing more is
+        # submitted: hand what the shards still hold to the ingest queue
+        # (ingest_worker is stopped after this task) before cancelling them.
+        await dispatcher.stop(MQTT_SHARD_DRAIN_SECONDS)
+
+
+def publish_command(device_id: str, command: str, payload: dict, qos: int = MQTT_COMMAND_QOS) -> None:
+    """
+    Queue a command for `{BROKER_TOPIC}/{device_id}/{command}` on the shared
+    publisher connection. Raises asyncio.QueueFull when the outbox is full.
+    """
+    topic = f"{BROKER_TOPIC}/{device_id}/{command}"
+    get_outbox().put_nowait((topic, json.dumps(payload), qos))
 
-                        enabled = not pin_info["enabled"]
-
-                        print(f"PIN {pin} -> ENABLED {enabled}")
-                        db.set_user_pins_enabled(pin=pin, enabled=enabled)
-                        await broadcast(
-                            {
-                                "topic": topic.value,
-                                "pin": pin,
-                                "enabled": enabled,
-                                "uuid": uuid,
-                                "ts": ts,
-                            }
-                        )
-                        continue
-
-                    if action == "count":
-                        mode = get_device_mode(pin)
-                        change = 1 if mode == "increment" else -1
-                        pin_info = db.get_pin_by_id(pin)
-                        if pin_info is None or not pin_info["enabled"]:
-                            continue
 
-                        print(f"PIN {pin} -> CHANGE {change}")
-                        new_count = apply_change(pin=pin, change=change, ts=ts)
-                        await broadcast(
-                            {
-                                "topic": topic.value,
-                                "pin": pin,
-                                "change": change,
-                                "new_count": new_count,
-                                "ts": ts,
-                            }
-                        )
-        except Exception as e:
-            print("MQTT error:", e)
-            await asyncio.sleep(3)
+async def publish_reset(device_id: str):
+    log.info("publish reset to %s/%s/reset", BROKER_TOPIC, device_id, extra={"pin": device_id})
+    publish_command(device_id, "reset", {"reset": True})
+
+
+async def publish_resets(device_ids) -> None:
+    """
+    Queue reset commands for many devices; the publisher sends them as
+    pipelined batches. Waits for room in the outbox, at most
+    MQTT_ENQUEUE_TIMEOUT_SECONDS overall (then asyncio.TimeoutError, with
+    the commands queued so far still going out).
+    """
+    device_ids = list(device_ids)
+    log.info("publish %d resets to %s/+/reset", len(device_ids), BROKER_TOPIC, extra={"devices": len(device_ids)})
+    payload = json.dumps({"reset": True})
+    outbox = get_outbox()
 
+    async def enqueue():
+        for device_id in device_ids:
+            await outbox.put((f"{BROKER_TOPIC}/{device_id}/reset", payload, MQTT_COMMAND_QOS))
 
-async def publish_reset(device_id: str):
+    await asyncio.wait_for(enqueue(), MQTT_ENQUEUE_TIMEOUT_SECONDS)
+
+
+async def mqtt_publisher():
     cfg = parse_mqtt_url(BROKER_URL)
-    topic = f"{BROKER_TOPIC}/{device_id}/reset"
-    payload = json.dumps({"reset": True})
-    print("MQTT publish reset to", topic)
-    async with Client(cfg["host"], cfg["port"]) as client:
-        await client.publish(topic, payload)
+    outbox = get_outbox()
+    delay = MQTT_RECONNECT_MIN_SECONDS
+    pending = []
+    while True:
+        try:
+            client = Client(cfg["host"], cfg["port"], max_inflight_messages=MQTT_PUBLISH_BATCH)
+            # A full batch of pending acknowledgements is expected, not a warning.
+            client.pending_calls_threshold = MQTT_PUBLISH_BATCH
+            async with client:
+                log.info("publisher connected to %s", BROKER_URL)
+                delay = MQTT_RECONNECT_MIN_SECONDS
+                while True:
+                    if not pending:
+                        pending.append(await outbox.get())
+                        while len(pending) < MQTT_PUBLISH_BATCH and not outbox.empty():
+                            pending.append(outbox.get_nowait())
+                    # Everything already queued goes out without waiting for
+                    # each acknowledgement in turn.
+                    await asyncio.gather(*(client.publish(topic, payload, qos=qos) for topic, payload, qos in pending))
+                    # Only forget the commands once the broker accepted them,
+                    # so they are retried on the next connection otherwise
+                    # (the whole batch: a command may be delivered twice).
+                    pending = []
+        except Exception as e:
+            log.warning("publisher error: %s (retrying in %.1fs)", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MQTT_RECONNECT_MAX_SECONDS)
@@ -0,0 +1,169 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from .config import (
+    PASSWORD_SCRYPT_N,
+    PASSWORD_SCRYPT_R,
+    PASSWORD_SCRYPT_P,
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_USER_CONCURRENCY,
+    PASSWORD_USER_MAX_PENDING,
+)
+
+# Stored format: scrypt$<n>$<r>$<p>$<salt b64>$<hash b64>. Anything else is a
+# legacy plaintext password from before hashing was introduced.
+SCHEME = "scrypt"
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode("utf-8"),
+        salt=salt,
+        n=n,
+        r=r,
+        p=p,
+        maxmem=256 * n * r + 1024 * 1024,
+        dklen=HASH_BYTES,
+    )
+
+
+def hash_password(password: str) -> str:
+    salt = os.urandom(SALT_BYTES)
+    digest = _scrypt(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return "$".join(
+        (SCHEME, str(PASSWORD_SCRYPT_N), str(PASSWORD_SCRYPT_R), str(PASSWORD_SCRYPT_P), _b64(salt), _b64(digest))
+    )
+
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith(SCHEME + "$")
+
+
+def needs_rehash(stored: str) -> bool:
+    """True for plaintext rows and hashes made with older cost parameters."""
+    if not is_hashed(stored):
+        return True
+    _, n, r, p, _, _ = stored.split("$")
+    return (int(n), int(r), int(p)) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+
+
+def verify_password(stored: str, password: str) -> bool:
+    if not is_hashed(stored):
+        return hmac.compare_digest(stored.encode("utf-8"), password.encode("utf-8"))
+    try:
+        _, n, r, p, salt, digest = stored.split("$")
+        expected = base64.b64decode(digest)
+        actual = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, actual)
+
+
+# Checked when the username does not exist, so unknown and known users cost
+# the same KDF run.
+_dummy_hash = None
+
+
+def verify_unknown_user(password: str) -> bool:
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = hash_password(_b64(os.urandom(SALT_BYTES)))
+    verify_password(_dummy_hash, password)
+    return False
+
+
+def get_executor() -> ThreadPoolExecutor:
+    # hashlib.scrypt releases the GIL, so threads give real parallelism while
+    # keeping the KDF off the event loop and capped at PASSWORD_HASH_WORKERS.
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="kdf")
+    return _executor
+
+
+async def run_kdf(fn, *args, **kwargs):
+    """Run a password hashing function on the bounded KDF thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), partial(fn, *args, **kwargs))
+
+
+def close_executor() -> None:
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+class TooManyAttempts(Exception):
+    pass
+
+
+class UserLimiter:
+    """
+    Caps concurrent KDF runs per username.
+
+    At most `concurrency` hashes run for one username at a time and at most
+    `max_pending` more may wait; further attempts are refused immediately, so
+    hammering one account cannot occupy the whole KDF pool.
+    """
+
+    def __init__(self, concurrency: int, max_pending: int):
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max(0, max_pending)
+        self._slots = {}
+        self.rejected = 0
+
+    def __call__(self, username: str):
+        return _UserSlot(self, username.lower())
+
+
+class _UserSlot:
+    def __init__(self, limiter: UserLimiter, key: str):
+        self.limiter = limiter
+        self.key = key
+
+    async def __aenter__(self):
+        slots = self.limiter._slots
+        entry = slots.get(self.key)
+        if entry is None:
+            entry = slots[self.key] = [asyncio.Semaphore(self.limiter.concurrency), 0]
+        if entry[1] >= self.limiter.concurrency + self.limiter.max_pending:
+            self.limiter.rejected += 1
+            raise TooManyAttempts(self.key)
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._leave(entry)
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        entry = self.limiter._slots[self.key]
+        entry[0].release()
+        self._leave(entry)
+
+    def _leave(self, entry) -> None:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.limiter._slots[self.key]
+
+
+user_limiter = UserLimiter(PASSWORD_USER_CONCURRENCY, PASSWORD_USER_MAX_PENDING)
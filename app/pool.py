@@ -0,0 +1,207 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from .config import (
+    SQLITE_DB_PATH,
+    SQLITE_SYNCHRONOUS,
+    SQLITE_CACHE_SIZE,
+    SQLITE_MMAP_SIZE,
+    SQLITE_BUSY_TIMEOUT_MS,
+    DB_READERS,
+    DB_EXECUTOR_WORKERS,
+)
+from .metrics import CollectedCounter, Gauge, Histogram, timed
+
+DB_CALL_SECONDS = Histogram("db_call_seconds", "Time spent inside each db function", labels=("function",))
+TRANSACTION_SECONDS = Histogram("sqlite_transaction_seconds", "Write transactions from BEGIN IMMEDIATE to COMMIT")
+LOCK_WAIT_SECONDS = Histogram("sqlite_writer_lock_wait_seconds", "Wait for the writer connection's lock")
+
+
+def open_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        SQLITE_DB_PATH,
+        check_same_thread=False,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+    )
+    conn.row_factory = sqlite3.Row
+    # Per-connection settings; journal_mode is persistent and set by the schema migration.
+    conn.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+    conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    return conn
+
+
+class ConnectionPool:
+    """
+    One writer connection, serialized by a lock, and up to `readers` reader
+    connections handed out from a queue. Connections are opened lazily and
+    kept for the lifetime of the pool.
+    """
+
+    def __init__(self, readers: int):
+        self.max_readers = max(1, readers)
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._readers = queue.LifoQueue()
+        self._all_readers = []
+        self._readers_lock = threading.Lock()
+        self._closed = False
+        # Write transactions so far, and (lock wait, BEGIN..COMMIT) seconds of the latest ones.
+        self.transactions = 0
+        self._timings = deque(maxlen=1024)
+
+    @contextmanager
+    def writer(self):
+        start = time.perf_counter()
+        with self._writer_lock:
+            acquired = time.perf_counter()
+            if self._closed:
+                raise RuntimeError("connection pool is closed")
+            if self._writer is None:
+                self._writer = open_connection()
+            conn = self._writer
+            # Take the write lock up front so a transaction that reads before
+            # writing cannot be overtaken by another process's commit.
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                held = time.perf_counter() - acquired
+                self.transactions += 1
+                self._timings.append((acquired - start, held))
+                LOCK_WAIT_SECONDS.observe(acquired - start)
+                TRANSACTION_SECONDS.observe(held)
+
+    @contextmanager
+    def local_writes_blocked(self):
+        """
+        Hold the writer's lock without opening a transaction: no write from
+        this process can commit meanwhile, while other processes (and the
+        SQLite write lock) are not affected.
+        """
+        with self._writer_lock:
+            if self._closed:
+                raise RuntimeError("connection pool is closed")
+            yield
+
+    def stats(self) -> dict:
+        timings = list(self._timings)
+        waits = sorted(wait for wait, _ in timings)
+        held = sorted(duration for _, duration in timings)
+
+        def ms(values, q):
+            return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3) if values else 0.0
+
+        return {
+            "transactions": self.transactions,
+            "readers_open": len(self._all_readers),
+            "transaction_ms": {"p50": ms(held, 0.5), "p99": ms(held, 0.99), "max": ms(held, 1.0)},
+            "lock_wait_ms": {"p50": ms(waits, 0.5), "p99": ms(waits, 0.99), "max": ms(waits, 1.0)},
+        }
+
+    @contextmanager
+    def reader(self):
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        if self._closed:
+            raise RuntimeError("connection pool is closed")
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._readers_lock:
+            if len(self._all_readers) < self.max_readers:
+                conn = open_connection()
+                self._all_readers.append(conn)
+                return conn
+        return self._readers.get()
+
+    def close(self) -> None:
+        self._closed = True
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._readers_lock:
+            for conn in self._all_readers:
+                conn.close()
+            self._all_readers.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_executor = None
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_READERS)
+    return _pool
+
+
+def writer():
+    return get_pool().writer()
+
+
+def reader():
+    return get_pool().reader()
+
+
+def local_writes_blocked():
+    return get_pool().local_writes_blocked()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _pool_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _executor
+
+
+def _timed_call(histogram, fn, args, kwargs):
+    with timed(histogram):
+        return fn(*args, **kwargs)
+
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking db function on the dedicated DB thread pool."""
+    loop = asyncio.get_running_loop()
+    histogram = DB_CALL_SECONDS.labels(fn.__name__)
+    return await loop.run_in_executor(get_executor(), partial(_timed_call, histogram, fn, args, kwargs))
+
+
+def close_pool() -> None:
+    global _pool, _executor
+    with _pool_lock:
+        executor, _executor = _executor, None
+        pool, _pool = _pool, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    if pool is not None:
+        pool.close()
+
+
+CollectedCounter("sqlite_transactions_total", "Write transactions committed or rolled back", lambda: get_pool().transactions)
+Gauge("sqlite_readers_open", "Reader connections opened by the pool", lambda: len(get_pool()._all_readers))
@@ -0,0 +1,368 @@
+import threading
+from typing import Dict, Iterable, Optional, Set, Tuple
+from .metrics import CollectedCounter, Gauge
+
+
+class DeviceState:
+    __slots__ = ("pin", "mode", "enabled", "count", "owners", "version", "last_seq", "last_boot")
+
+    def __init__(
+        self,
+        pin: str,
+        mode: str,
+        enabled: bool,
+        count: int,
+        version: int = 0,
+        last_seq: Optional[int] = None,
+        last_boot: Optional[int] = None,
+    ):
+        self.pin = pin
+        self.mode = mode
+        self.enabled = enabled
+        self.count = count
+        self.version = version
+        self.last_seq = last_seq
+        self.last_boot = last_boot
+        self.owners: Set[int] = set()
+
+    def as_dict(self, enabled: bool) -> dict:
+        # `enabled` as DeviceRegistry.is_enabled() sees it, owners included.
+        return {"pin": self.pin, "enabled": enabled, "current_count": self.count, "mode": self.mode}
+
+
+class DeviceRegistry:
+    """
+    In-process copy of the devices / user_devices tables.
+
+    Loaded once at startup and kept up to date by the db.py write functions
+    after each commit, so readers never have to go back to SQLite. Mutations
+    happen on DB executor threads and are serialized by a lock; lookups are
+    plain dict reads.
+
+    When other processes write to the same database (cluster mode) `shared`
+    is set, and `on_change(pins, links, badges)` is called after every
+    local mutation so peers can refresh those pins and badges.
+
+    A device counts (and shows as enabled) only while its own flag is set and
+    none of its owners is a disabled user.
+
+    RFID badges map to the user holding them; a tap on a pin is authorized
+    when that user is one of the pin's owners, so link changes need no
+    badge bookkeeping.
+
+    Every write carries the sync_state version it committed under. Devices,
+    links and unlink tombstones keep theirs, and each user's version is the
+    highest of those for their pins, so "did anything change since N" is a
+    dict lookup. Writers must update the registry before releasing the DB
+    write lock so versions arrive here in commit order.
+    """
+
+    def __init__(self):
+        self._devices: Dict[str, DeviceState] = {}
+        # user_id -> {pin: version of the link}, and pin -> its owners' ids
+        self._user_pins: Dict[int, Dict[str, int]] = {}
+        self._pin_owners: Dict[str, Set[int]] = {}
+        # user_id -> {pin: version of the unlink}
+        self._removals: Dict[int, Dict[str, int]] = {}
+        self._user_versions: Dict[int, int] = {}
+        self._disabled_users: Set[int] = set()
+        # badge uid -> user_id, and user_id -> that user's badge uids
+        self._badges: Dict[str, int] = {}
+        self._user_badges: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.shared = False
+        self.on_change = None
+        self.hits = 0
+        self.misses = 0
+
+    def _notify(self, pins, links=(), badges=()) -> None:
+        if self.on_change is not None:
+            self.on_change(pins, links, badges)
+
+    def _bump_user(self, user_id: int, version: int) -> None:
+        if version > self._user_versions.get(user_id, 0):
+            self._user_versions[user_id] = version
+
+    def _touch(self, state: DeviceState, version: int) -> None:
+        if version:
+            state.version = version
+            for user_id in state.owners:
+                self._bump_user(user_id, version)
+
+    def _add_links(self, links: Iterable[tuple], removals: Iterable[tuple]) -> None:
+        for user_id, pin, version in links:
+            self._user_pins.setdefault(user_id, {})[pin] = version
+            self._pin_owners.setdefault(pin, set()).add(user_id)
+            self._bump_user(user_id, version)
+            state = self._devices.get(pin)
+            if state is not None:
+                state.owners.add(user_id)
+                self._bump_user(user_id, state.version)
+        for user_id, pin, version in removals:
+            self._removals.setdefault(user_id, {})[pin] = version
+            self._bump_user(user_id, version)
+
+    def replace(
+        self,
+        devices: Iterable[DeviceState],
+        links: Iterable[tuple],
+        removals: Iterable[tuple] = (),
+        disabled_users: Iterable[int] = (),
+        badges: Iterable[tuple] = (),
+    ) -> None:
+        with self._lock:
+            self._devices = {state.pin: state for state in devices}
+            self._badges = {}
+            self._user_badges = {}
+            self._add_badges(badges)
+            self._user_pins = {}
+            self._pin_owners = {}
+            self._removals = {}
+            self._user_versions = {}
+            self._disabled_users = set(disabled_users)
+            self._add_links(links, removals)
+            self.loaded = True
+
+    def refresh(self, pins: Iterable[str], devices: Iterable[DeviceState], links: Iterable[tuple], users: Iterable[tuple] = ()) -> None:
+        """
+        Replace the entries for `pins` with freshly read rows, and the
+        enabled flags of `users` ((user_id, enabled) pairs), without
+        notifying. Only used in shared mode, where snapshots are read from the
+        database, so unlink tombstones are not tracked here. The caller holds
+        off this process's DB writes from the read until this returns, so no
+        newer local write can be replaced by the snapshot.
+        """
+        with self._lock:
+            for user_id, enabled in users:
+                if enabled:
+                    self._disabled_users.discard(user_id)
+                else:
+                    self._disabled_users.add(user_id)
+            for pin in pins:
+                self._devices.pop(pin, None)
+                for user_id in self._pin_owners.pop(pin, ()):
+                    user_pins = self._user_pins.get(user_id)
+                    if user_pins is not None:
+                        user_pins.pop(pin, None)
+                        if not user_pins:
+                            del self._user_pins[user_id]
+            for state in devices:
+                self._devices[state.pin] = state
+            self._add_links(links, ())
+
+    def refresh_badges(self, uids: Iterable[str], badges: Iterable[tuple]) -> None:
+        """refresh() for badges: drop `uids`, then add the (uid, user_id) rows read back for them."""
+        with self._lock:
+            self._drop_badges(uids)
+            self._add_badges(badges)
+
+    def _add_badges(self, badges: Iterable[tuple]) -> None:
+        for uid, user_id in badges:
+            self._badges[uid] = user_id
+            self._user_badges.setdefault(user_id, set()).add(uid)
+
+    def _drop_badges(self, uids: Iterable[str]) -> None:
+        for uid in uids:
+            user_id = self._badges.pop(uid, None)
+            user_badges = self._user_badges.get(user_id)
+            if user_badges is not None:
+                user_badges.discard(uid)
+                if not user_badges:
+                    del self._user_badges[user_id]
+
+    def set_badges(self, user_id: int, uids: Iterable[str]) -> None:
+        """Make `uids` the user's badges: only the entries that changed are touched."""
+        uids = set(uids)
+        with self._lock:
+            changed = self._user_badges.get(user_id, set()) ^ uids
+            self._drop_badges(changed)
+            self._add_badges((uid, user_id) for uid in changed & uids)
+        self._notify((), (), sorted(changed))
+
+    def badges_of(self, user_id: int) -> list:
+        return sorted(self._user_badges.get(user_id, ()))
+
+    def badge_user(self, pin: str, uid: str) -> Optional[int]:
+        """The user holding badge `uid`, if they own `pin`; two dict lookups and a set test."""
+        user_id = self._badges.get(uid)
+        if user_id is None:
+            return None
+        state = self._devices.get(pin)
+        if state is None or user_id not in state.owners:
+            return None
+        return user_id
+
+    def get(self, pin: str) -> Optional[DeviceState]:
+        state = self._devices.get(pin)
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return state
+
+    def put(self, pin: str, mode: str, enabled: bool, count: int, version: int = 0) -> DeviceState:
+        with self._lock:
+            state = self._put(pin, mode, enabled, count, version)
+        self._notify((pin,))
+        return state
+
+    def put_many(self, rows: Iterable[tuple], version: int = 0) -> None:
+        """put() for many (pin, mode, enabled, count) rows, under one lock and one notification."""
+        pins = []
+        with self._lock:
+            for pin, mode, enabled, count in rows:
+                self._put(pin, mode, enabled, count, version)
+                pins.append(pin)
+        self._notify(pins)
+
+    def _put(self, pin: str, mode: str, enabled: bool, count: int, version: int) -> DeviceState:
+        state = self._devices.get(pin)
+        if state is None:
+            state = DeviceState(pin, mode, enabled, count)
+            state.owners.update(self._pin_owners.get(pin, ()))
+            self._devices[pin] = state
+        else:
+            state.mode = mode
+            state.enabled = enabled
+            state.count = count
+        self._touch(state, version)
+        return state
+
+    def set_last_seqs(self, seqs: Dict[str, Tuple[int, Optional[int]]]) -> None:
+        """Record the device (seq, boot) last applied per pin; not a change dashboards see."""
+        with self._lock:
+            for pin, (seq, boot) in seqs.items():
+                state = self._devices.get(pin)
+                if state is not None:
+                    state.last_seq = seq
+                    state.last_boot = boot
+        self._notify(list(seqs))
+
+    def set_mode(self, pins: Iterable[str], mode: str, version: int = 0) -> None:
+        pins = list(pins)
+        with self._lock:
+            for pin in pins:
+                state = self._devices.get(pin)
+                if state is not None:
+                    state.mode = mode
+                    self._touch(state, version)
+        self._notify(pins)
+
+    def set_enabled(self, pins: Iterable[str], enabled: bool, version: int = 0) -> None:
+        pins = list(pins)
+        with self._lock:
+            for pin in pins:
+                state = self._devices.get(pin)
+                if state is not None:
+                    state.enabled = enabled
+                    self._touch(state, version)
+        self._notify(pins)
+
+    def set_user_enabled(self, user_id: int, enabled: bool, version: int = 0) -> list:
+        """
+        Flip a user's flag; returns (pin, enabled) for each of the user's
+        devices, as they now show.
+        """
+        with self._lock:
+            if enabled:
+                self._disabled_users.discard(user_id)
+            else:
+                self._disabled_users.add(user_id)
+            self._bump_user(user_id, version)
+            changed = []
+            for pin in sorted(self._user_pins.get(user_id, ())):
+                state = self._devices.get(pin)
+                if state is not None:
+                    self._touch(state, version)
+                    changed.append((pin, self.is_enabled(state)))
+        self._notify([pin for pin, _ in changed])
+        return changed
+
+    def is_enabled(self, state: DeviceState) -> bool:
+        return state.enabled and self._disabled_users.isdisjoint(state.owners)
+
+    def add_owner(self, user_id: int, pins: Iterable[str], version: int = 0) -> None:
+        pins = list(pins)
+        with self._lock:
+            user_pins = self._user_pins.setdefault(user_id, {})
+            removals = self._removals.get(user_id)
+            for pin in pins:
+                user_pins[pin] = version
+                self._pin_owners.setdefault(pin, set()).add(user_id)
+                if removals is not None:
+                    removals.pop(pin, None)
+                state = self._devices.get(pin)
+                if state is not None:
+                    state.owners.add(user_id)
+            self._bump_user(user_id, version)
+        self._notify(pins, [(user_id, pin) for pin in pins])
+
+    def remove_owner(self, user_id: int, pins: Iterable[str], version: int = 0) -> None:
+        pins = list(pins)
+        with self._lock:
+            user_pins = self._user_pins.get(user_id)
+            removals = self._removals.setdefault(user_id, {})
+            for pin in pins:
+                if user_pins is not None:
+                    user_pins.pop(pin, None)
+                owners = self._pin_owners.get(pin)
+                if owners is not None:
+                    owners.discard(user_id)
+                    if not owners:
+                        del self._pin_owners[pin]
+                removals[pin] = version
+                state = self._devices.get(pin)
+                if state is not None:
+                    state.owners.discard(user_id)
+            if user_pins is not None and not user_pins:
+                del self._user_pins[user_id]
+            self._bump_user(user_id, version)
+        self._notify(pins, [(user_id, pin) for pin in pins])
+
+    def remove(self, pins: Iterable[str]) -> None:
+        pins = list(pins)
+        with self._lock:
+            for pin in pins:
+                self._devices.pop(pin, None)
+        self._notify(pins)
+
+    def user_version(self, user_id: int) -> int:
+        return self._user_versions.get(user_id, 0)
+
+    def user_devices(self, user_id: int, since: Optional[int] = None):
+        """
+        (version, devices, removed pins) for one user, consistent with each
+        other. With `since`, only pins changed or unlinked after that version.
+        """
+        with self._lock:
+            version = self._user_versions.get(user_id, 0)
+            devices = []
+            for pin, link_version in self._user_pins.get(user_id, {}).items():
+                state = self._devices.get(pin)
+                if state is None:
+                    continue
+                if since is None or max(link_version, state.version) > since:
+                    devices.append((state.pin, state.count, self.is_enabled(state), state.mode))
+            removed = []
+            if since is not None:
+                removed = [pin for pin, v in self._removals.get(user_id, {}).items() if v > since]
+        devices.sort()
+        return version, devices, sorted(removed)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "devices": len(self._devices),
+            "badges": len(self._badges),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+registry = DeviceRegistry()
+
+Gauge("registry_devices", "Devices held in the in-memory registry", lambda: len(registry._devices))
+CollectedCounter("registry_hits_total", "Device lookups answered by the registry", lambda: registry.hits)
+CollectedCounter("registry_misses_total", "Device lookups for pins the registry does not hold", lambda: registry.misses)
@@ -0,0 +1,145 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from .config import (
+    LOG_RETENTION_SECONDS,
+    LOG_RETENTION_OVERRIDES,
+    LOG_ARCHIVE_DIR,
+    RETENTION_INTERVAL_SECONDS,
+    RETENTION_CHUNK_SIZE,
+    RETENTION_PAUSE_MS,
+    RETENTION_VACUUM_PAGES,
+    parse_retention_overrides,
+)
+from .codecs import MAX_AGE_SECONDS
+from .pool import reader, writer, run_db
+
+log = logging.getLogger(__name__)
+
+# pin -> retention in seconds (0 keeps that pin's logs forever)
+RETENTION_OVERRIDES = parse_retention_overrides(LOG_RETENTION_OVERRIDES)
+
+
+def archive_path(day: str) -> str:
+    return os.path.join(LOG_ARCHIVE_DIR, f"logs-{day}.ndjson.gz")
+
+
+def write_archive(rows) -> None:
+    """
+    Append rows to one gzip NDJSON segment per UTC day. Each call adds a new
+    gzip member to the file; gzip readers see the members as a single stream.
+    """
+    by_day = {}
+    for r in rows:
+        day = datetime.fromtimestamp(r["ts"], tz=timezone.utc).strftime("%Y-%m-%d")
+        by_day.setdefault(day, []).append(r)
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    for day, day_rows in by_day.items():
+        lines = "".join(
+            json.dumps(
+                {"id": r["id"], "pin": r["pin"], "change": r["change"], "new_count": r["new_count"], "ts": r["ts"]},
+                separators=(",", ":"),
+            )
+            + "\n"
+            for r in day_rows
+        )
+        with open(archive_path(day), "ab") as f:
+            f.write(gzip.compress(lines.encode("utf-8")))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def fetch_expired_chunk(after_id: int, cutoff: int, pin=None):
+    """
+    Return (rows, last_id, done) for the next chunk of rows older than
+    `cutoff`, walking logs in id order. Timestamps mostly follow insertion
+    order, but a batched device count can be backdated by up to
+    MAX_AGE_SECONDS, so live rows are stepped over. The walk stops at the
+    first row live by more than that: every later row is live too.
+    """
+    with reader() as conn:
+        if pin is None:
+            rows = conn.execute(
+                "SELECT id, pin, change, new_count, ts FROM logs WHERE id > ? ORDER BY id LIMIT ?",
+                (after_id, RETENTION_CHUNK_SIZE),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT id, pin, change, new_count, ts FROM logs WHERE pin = ? AND id > ? ORDER BY id LIMIT ?",
+                (pin, after_id, RETENTION_CHUNK_SIZE),
+            ).fetchall()
+    expired = []
+    for r in rows:
+        if r["ts"] >= cutoff + MAX_AGE_SECONDS:
+            return expired, after_id, True
+        if r["ts"] < cutoff:
+            expired.append(r)
+        after_id = r["id"]
+    return expired, after_id, len(rows) < RETENTION_CHUNK_SIZE
+
+
+def delete_rows(ids) -> None:
+    with writer() as conn:
+        conn.executemany("DELETE FROM logs WHERE id = ?", [(i,) for i in ids])
+
+
+def incremental_vacuum() -> bool:
+    with writer() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return False
+        # The pragma frees one page per step and execute() steps only once;
+        # executescript() runs it to completion (committing the open
+        # transaction first, which holds nothing yet).
+        conn.executescript(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});")
+        return True
+
+
+async def expire_logs(cutoff: int, pin=None, skip=()) -> int:
+    """Archive then delete expired rows, one short write transaction per chunk."""
+    after_id = 0
+    total = 0
+    while True:
+        rows, after_id, done = await run_db(fetch_expired_chunk, after_id, cutoff, pin)
+        rows = [r for r in rows if r["pin"] not in skip]
+        if rows:
+            await asyncio.to_thread(write_archive, rows)
+            await run_db(delete_rows, [r["id"] for r in rows])
+            total += len(rows)
+        if done:
+            return total
+        await asyncio.sleep(RETENTION_PAUSE_MS / 1000)
+
+
+async def run_retention(now=None) -> int:
+    now = int(time.time()) if now is None else int(now)
+    total = 0
+    for pin, seconds in RETENTION_OVERRIDES.items():
+        if seconds > 0:
+            total += await expire_logs(now - seconds, pin=pin)
+    if LOG_RETENTION_SECONDS > 0:
+        total += await expire_logs(now - LOG_RETENTION_SECONDS, skip=RETENTION_OVERRIDES)
+    if total:
+        vacuumed = await run_db(incremental_vacuum)
+        log.info(
+            "archived %d log rows to %s%s",
+            total,
+            LOG_ARCHIVE_DIR,
+            "" if vacuumed else " (auto_vacuum off, no space reclaimed; see SQLITE_CONVERT_AUTO_VACUUM)",
+            extra={"rows": total},
+        )
+    return total
+
+
+async def retention_worker():
+    if LOG_RETENTION_SECONDS <= 0 and not any(s > 0 for s in RETENTION_OVERRIDES.values()):
+        return
+    while True:
+        try:
+            await run_retention()
+        except Exception:
+            log.exception("retention run failed")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
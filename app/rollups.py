@@ -0,0 +1,74 @@
+import sqlite3
+from typing import Iterable, Optional
+from .pool import reader
+
+# granularity -> bucket width in seconds (buckets are aligned on UTC epoch)
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+STATS_MAX_BUCKETS = 5000
+
+
+def record_rollups(conn: sqlite3.Connection, rows: Iterable[tuple]) -> None:
+    """
+    Fold freshly written log rows (pin, change, new_count, ts), in the order
+    they were applied, into log_rollups. Runs inside the caller's transaction.
+    """
+    buckets = {}
+    for pin, change, new_count, ts in rows:
+        for granularity, width in GRANULARITIES.items():
+            key = (pin, granularity, ts - ts % width)
+            agg = buckets.get(key)
+            if agg is None:
+                buckets[key] = [change, 1, new_count, new_count, new_count]
+            else:
+                agg[0] += change
+                agg[1] += 1
+                agg[2] = min(agg[2], new_count)
+                agg[3] = max(agg[3], new_count)
+                agg[4] = new_count
+    if not buckets:
+        return
+    conn.executemany(
+        """
+        INSERT INTO log_rollups(pin, granularity, bucket, changes, events, min_count, max_count, last_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(pin, granularity, bucket) DO UPDATE SET
+            changes = changes + excluded.changes,
+            events = events + excluded.events,
+            min_count = MIN(min_count, excluded.min_count),
+            max_count = MAX(max_count, excluded.max_count),
+            last_count = excluded.last_count
+        """,
+        [(pin, granularity, bucket, *agg) for (pin, granularity, bucket), agg in buckets.items()],
+    )
+
+
+def get_stats(pin: str, granularity: str, start: Optional[int], end: int):
+    if granularity not in GRANULARITIES:
+        raise ValueError("invalid granularity")
+    width = GRANULARITIES[granularity]
+    if start is None:
+        start = end - 24 * width
+    if start > end:
+        raise ValueError("start must be before end")
+    with reader() as conn:
+        rows = conn.execute(
+            """
+            SELECT bucket, changes, events, min_count, max_count, last_count
+            FROM log_rollups
+            WHERE pin = ? AND granularity = ? AND bucket >= ? AND bucket <= ?
+            ORDER BY bucket
+            LIMIT ?
+            """,
+            (pin, granularity, start - start % width, end, STATS_MAX_BUCKETS),
+        ).fetchall()
+    return [
+        {
+            "bucket": r["bucket"],
+            "changes": r["changes"],
+            "events": r["events"],
+            "min_count": r["min_count"],
+            "max_count": r["max_count"],
+            "last_count": r["last_count"],
+        }
+        for r in rows
+    ]
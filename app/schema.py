@@ -0,0 +1,253 @@
+import logging
+import sqlite3
+import time
+from .config import SQLITE_CONVERT_AUTO_VACUUM, SQLITE_JOURNAL_MODE
+from .rollups import GRANULARITIES
+
+log = logging.getLogger(__name__)
+
+
+def _create_base_tables(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL UNIQUE,
+            password TEXT NOT NULL,
+            rfid_uid TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS devices (
+            pin TEXT PRIMARY KEY,
+            enabled BOOLEAN NOT NULL DEFAULT 1,
+            current_count INTEGER NOT NULL DEFAULT 0,
+            mode TEXT NOT NULL DEFAULT 'increment'
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_devices (
+            user_id INTEGER NOT NULL,
+            pin TEXT NOT NULL,
+            UNIQUE(user_id, pin)
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pin TEXT NOT NULL,
+            change INTEGER NOT NULL,
+            new_count INTEGER NOT NULL,
+            ts INTEGER NOT NULL
+        )
+        """
+    )
+
+
+def _add_lookup_indexes(conn: sqlite3.Connection) -> None:
+    # get_logs and the unlink cleanup filter logs by pin and order by id.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_logs_pin_id ON logs(pin, id)")
+    # user_devices is only indexed on (user_id, pin); owner lookups go by pin.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_devices_pin ON user_devices(pin, user_id)")
+
+
+def _create_log_rollups(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS log_rollups (
+            pin TEXT NOT NULL,
+            granularity TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            changes INTEGER NOT NULL,
+            events INTEGER NOT NULL,
+            min_count INTEGER NOT NULL,
+            max_count INTEGER NOT NULL,
+            last_count INTEGER NOT NULL,
+            PRIMARY KEY (pin, granularity, bucket)
+        ) WITHOUT ROWID
+        """
+    )
+    # Backfill from the history already in logs.
+    for granularity, width in GRANULARITIES.items():
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO log_rollups(pin, granularity, bucket, changes, events, min_count, max_count, last_count)
+            SELECT g.pin, ?, g.bucket, g.changes, g.events, g.min_count, g.max_count,
+                   (SELECT new_count FROM logs WHERE id = g.last_id)
+            FROM (
+                SELECT pin, ts - ts % ? AS bucket, SUM(change) AS changes, COUNT(*) AS events,
+                       MIN(new_count) AS min_count, MAX(new_count) AS max_count, MAX(id) AS last_id
+                FROM logs
+                GROUP BY pin, bucket
+            ) AS g
+            """,
+            (granularity, width),
+        )
+
+
+def _add_sync_versions(conn: sqlite3.Connection) -> None:
+    # One database-wide counter, bumped by every write that changes what a
+    # user's device list looks like; rows remember the version that last
+    # touched them so clients can ask for "everything after version N".
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sync_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute("INSERT OR IGNORE INTO sync_state(id, version) VALUES (1, 0)")
+    conn.execute("ALTER TABLE devices ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    conn.execute("ALTER TABLE user_devices ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    # Tombstones for unlinked pins, so deltas can report removals.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS device_removals (
+            user_id INTEGER NOT NULL,
+            pin TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (user_id, pin)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+
+def _add_user_enabled(conn: sqlite3.Connection) -> None:
+    # An RFID toggle enables or disables all of a user's devices; keep that as
+    # one flag on the user (with the version that last flipped it) instead of
+    # rewriting every device row. A device counts when its own flag and all
+    # of its owners' flags are set.
+    conn.execute("ALTER TABLE users ADD COLUMN enabled BOOLEAN NOT NULL DEFAULT 1")
+    conn.execute("ALTER TABLE users ADD COLUMN enabled_version INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_rfid_uid ON users(rfid_uid)")
+    # Users whose devices a toggle left all disabled become disabled users
+    # with enabled devices, so the next toggle turns them back on.
+    conn.execute(
+        """
+        UPDATE users SET enabled = 0
+        WHERE EXISTS (SELECT 1 FROM user_devices ud WHERE ud.user_id = users.id)
+          AND NOT EXISTS (
+              SELECT 1 FROM user_devices ud JOIN devices d ON d.pin = ud.pin
+              WHERE ud.user_id = users.id AND d.enabled
+          )
+        """
+    )
+    conn.execute(
+        """
+        UPDATE devices SET enabled = 1
+        WHERE pin IN (SELECT ud.pin FROM user_devices ud JOIN users u ON u.id = ud.user_id WHERE NOT u.enabled)
+        """
+    )
+
+
+def _create_rfid_badges(conn: sqlite3.Connection) -> None:
+    # A user can hold several badges; a badge belongs to one user. Existing
+    # users.rfid_uid values move here (the lowest user id keeps a shared
+    # one); the column stays for older code but is no longer read.
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rfid_badges (
+            uid TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rfid_badges_user ON rfid_badges(user_id)")
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO rfid_badges(uid, user_id)
+        SELECT rfid_uid, id FROM users WHERE rfid_uid IS NOT NULL AND rfid_uid != '' ORDER BY id
+        """
+    )
+    conn.execute("DROP INDEX IF EXISTS idx_users_rfid_uid")
+
+
+def _add_device_last_seq(conn: sqlite3.Connection) -> None:
+    # Seq of the last count message applied per pin (NULL until a device
+    # sends one), committed with the counts it carried.
+    conn.execute("ALTER TABLE devices ADD COLUMN last_seq INTEGER")
+
+
+def _add_device_last_boot(conn: sqlite3.Connection) -> None:
+    # Boot that last_seq belongs to (NULL for devices that do not send one);
+    # a different boot starts a new seq run.
+    conn.execute("ALTER TABLE devices ADD COLUMN last_boot INTEGER")
+
+
+# Each entry upgrades the schema by one version; PRAGMA user_version records
+# the last one applied. Only append to this list, never reorder it.
+MIGRATIONS = [
+    _create_base_tables,
+    _add_lookup_indexes,
+    _create_log_rollups,
+    _add_sync_versions,
+    _add_user_enabled,
+    _create_rfid_badges,
+    _add_device_last_seq,
+    _add_device_last_boot,
+]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return int(conn.execute("PRAGMA user_version").fetchone()[0])
+
+
+def configure_database(conn: sqlite3.Connection) -> None:
+    """Apply database-wide (persistent) settings; must run outside a transaction."""
+    if int(conn.execute("PRAGMA page_count").fetchone()[0]) == 0:
+        # Only possible before the first table exists; lets the retention job
+        # hand freed pages back with PRAGMA incremental_vacuum.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    elif SQLITE_CONVERT_AUTO_VACUUM and int(conn.execute("PRAGMA auto_vacuum").fetchone()[0]) != 2:
+        convert_auto_vacuum(conn)
+    if SQLITE_JOURNAL_MODE:
+        conn.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+
+
+def convert_auto_vacuum(conn: sqlite3.Connection) -> None:
+    """Rebuild an existing database with auto_vacuum = INCREMENTAL (runs VACUUM once)."""
+    log.info("converting the database to auto_vacuum=INCREMENTAL, this rebuilds the whole file")
+    start = time.monotonic()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    try:
+        conn.execute("VACUUM")
+    except sqlite3.OperationalError as e:
+        # E.g. another worker holds the database (or is converting it).
+        log.warning("auto_vacuum conversion skipped: %s", e)
+        return
+    log.info("auto_vacuum conversion done in %.1fs", time.monotonic() - start)
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Bring the database up to the latest schema version, one transaction per step."""
+    if conn.in_transaction:
+        conn.commit()
+    configure_database(conn)
+    version = schema_version(conn)
+    for target, step in enumerate(MIGRATIONS, start=1):
+        if target <= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        if schema_version(conn) >= target:
+            # Another process applied this step while we waited for the lock.
+            conn.rollback()
+            version = target
+            continue
+        try:
+            step(conn)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        log.info("DB migrated to schema version %d (%s)", target, step.__name__.strip("_"))
+        version = target
+    return version
@@ -1,37 +1,317 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+import asyncio
 import json
-from .db import is_pin_owned_by_user
+import secrets
+from collections import deque
+from .config import (
+    WS_REPLAY_BUFFER_SIZE,
+    WS_SEND_QUEUE_SIZE,
+    WS_SLOW_CONSUMER_POLICY,
+    WS_CONFLATE_WINDOW_MS,
+    WS_CONFLATE_MIN_MS,
+    WS_CONFLATE_MAX_MS,
+)
+from .db import owned_pins
+from .metrics import Counter, Gauge
+from .pool import run_db
 from .auth import verify_token
+from .registry import registry
 
 router = APIRouter()
-clients = set()
-subscriptions = {}
-owners = {}
+connections = {}
+pin_subscribers = {}
+# Set in cluster mode: hands every broadcast to the ingestion leader, which
+# stamps it and delivers it to all workers.
+relay = None
 
-async def broadcast(msg: dict):
-    if not clients:
-        return
-    
-    pin = msg.get("pin")
-    if not pin:
-        return
-    
-    data = json.dumps(msg)
-    dead = []
-    for ws in list(clients):
+# Replayed events are sent as array frames of at most this many events.
+REPLAY_FRAME_EVENTS = 500
+
+FRAMES_SENT = Counter("ws_frames_sent_total", "Frames written to dashboard WebSockets")
+FRAMES_DROPPED = Counter("ws_frames_dropped_total", "Frames discarded because a dashboard's send queue was full")
+Gauge("ws_connections", "Connected dashboards", lambda: len(connections))
+
+
+class EventLog:
+    """
+    Recent broadcasts, for dashboards resuming after a reconnect.
+
+    Every event gets the next `seq` of the current `stream`; a stream is one
+    unbroken sequence (a process lifetime, or one cluster leader's term), so
+    a client's last seq is only meaningful with its stream id. The newest
+    WS_REPLAY_BUFFER_SIZE events are kept in one ring, indexed per pin; for
+    each pin `floor` remembers the newest seq evicted, below which that pin's
+    history is incomplete.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.reset(secrets.token_hex(8))
+
+    def reset(self, stream: str, seq: int = 0) -> None:
+        self.stream = stream
+        self.seq = seq
+        # Nothing at or before `base` was seen by this process.
+        self.base = seq
+        self.ring = deque()
+        self.by_pin = {}
+        self.floor = {}
+
+    def stamp(self, msg: dict) -> dict:
+        self.seq += 1
+        msg["seq"] = self.seq
+        self.record(msg)
+        return msg
+
+    def record(self, msg: dict) -> None:
+        seq = msg["seq"]
+        pin = msg["pin"]
+        self.seq = max(self.seq, seq)
+        self.ring.append((seq, pin))
+        self.by_pin.setdefault(pin, deque()).append((seq, msg))
+        while len(self.ring) > self.size:
+            old_seq, old_pin = self.ring.popleft()
+            events = self.by_pin[old_pin]
+            events.popleft()
+            if not events:
+                del self.by_pin[old_pin]
+            self.floor[old_pin] = old_seq
+
+    def replay(self, pins, stream, last_seq):
+        """
+        Events after `last_seq` for `pins`, in seq order, plus the pins whose
+        gap can no longer be filled from the buffer.
+        """
+        if stream != self.stream or not self.base <= last_seq <= self.seq:
+            return [], sorted(pins)
+        events, stale = [], []
+        for pin in pins:
+            if last_seq < self.floor.get(pin, 0):
+                stale.append(pin)
+                continue
+            missed = []
+            for seq, msg in reversed(self.by_pin.get(pin, ())):
+                if seq <= last_seq:
+                    break
+                missed.append(msg)
+            events.extend(missed)
+        events.sort(key=lambda msg: msg["seq"])
+        return events, sorted(stale)
+
+
+events = EventLog(WS_REPLAY_BUFFER_SIZE)
+
+
+class Connection:
+    """
+    A connected dashboard. Frames are queued and sent by a dedicated writer
+    task, so a slow browser only ever delays itself.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.pins = set()
+        self.outbox = deque()
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.writer_task = None
+        # Conflation mode: updates are held for `conflate_window` seconds and
+        # sent as one JSON array frame, with count updates merged per pin.
+        self.conflate_window = None
+        self.pending = []
+        self.pending_counts = {}
+        self.flush_handle = None
+
+    def push(self, pin: str, msg: dict, data: str) -> None:
+        if self.conflate_window is None:
+            self.enqueue(pin, data)
+            return
+
+        if "new_count" in msg:
+            index = self.pending_counts.get(pin)
+            if index is not None:
+                merged = self.pending[index]
+                change = merged.get("change", 0) + msg.get("change", 0)
+                merged.update(msg)
+                merged["change"] = change
+            else:
+                self.pending_counts[pin] = len(self.pending)
+                self.pending.append(dict(msg))
+        else:
+            # Keep ordering: later counts for this pin must not merge across it.
+            self.pending_counts.pop(pin, None)
+            self.pending.append(msg)
+
+        if self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_later(self.conflate_window, self.flush_pending)
+
+    def flush_pending(self) -> None:
+        self.flush_handle = None
+        if not self.pending:
+            return
+        batch, self.pending, self.pending_counts = self.pending, [], {}
+        self.enqueue(None, json.dumps(batch))
+
+    def set_conflation(self, window_ms) -> None:
+        if window_ms is None:
+            self.flush_pending()
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+                self.flush_handle = None
+            self.conflate_window = None
+            return
+        window_ms = max(WS_CONFLATE_MIN_MS, min(WS_CONFLATE_MAX_MS, int(window_ms)))
+        self.conflate_window = window_ms / 1000
+
+    def enqueue(self, pin, data: str) -> None:
+        if len(self.outbox) >= WS_SEND_QUEUE_SIZE:
+            self.dropped += 1
+            FRAMES_DROPPED.inc()
+            if not (WS_SLOW_CONSUMER_POLICY == "coalesce" and self._drop_queued(pin)):
+                self.outbox.popleft()
+        self.outbox.append((pin, data))
+        self.wakeup.set()
+
+    def _drop_queued(self, pin) -> bool:
+        # Coalesce: the new frame supersedes the oldest one still queued for the same pin.
+        if pin is None:
+            return False
+        for index, (queued_pin, _) in enumerate(self.outbox):
+            if queued_pin == pin:
+                del self.outbox[index]
+                return True
+        return False
+
+    async def run_writer(self) -> None:
         try:
-            pins = subscriptions.get(ws, set())
-            if pin in pins:
-                await ws.send_text(data)
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.outbox:
+                    _, data = self.outbox.popleft()
+                    await self.websocket.send_text(data)
+                    FRAMES_SENT.inc()
         except Exception:
-            dead.append(ws)
+            unregister(self)
 
-    for ws in dead:
-        try:
-            clients.remove(ws)
-            subscriptions.pop(ws, None)
-        except KeyError:
-            pass
+
+def register(websocket: WebSocket, user_id: int) -> Connection:
+    conn = Connection(websocket, user_id)
+    connections[websocket] = conn
+    conn.writer_task = asyncio.create_task(conn.run_writer())
+    return conn
+
+
+def unregister(conn: Connection) -> None:
+    set_subscriptions(conn, set())
+    connections.pop(conn.websocket, None)
+    if conn.flush_handle is not None:
+        conn.flush_handle.cancel()
+        conn.flush_handle = None
+    task = conn.writer_task
+    if task is not None and task is not asyncio.current_task():
+        task.cancel()
+
+
+def set_subscriptions(conn: Connection, pins: set) -> None:
+    for pin in conn.pins - pins:
+        subscribers = pin_subscribers.get(pin)
+        if subscribers is not None:
+            subscribers.discard(conn)
+            if not subscribers:
+                del pin_subscribers[pin]
+    for pin in pins - conn.pins:
+        pin_subscribers.setdefault(pin, set()).add(conn)
+    conn.pins = set(pins)
+
+
+async def broadcast(msg: dict):
+    await broadcast_many([msg])
+
+
+async def broadcast_many(msgs):
+    """
+    Broadcast several events at once, e.g. one per pin a toggle changed:
+    one relay message in cluster mode (see deliver() for the frames).
+    """
+    msgs = [msg for msg in msgs if msg.get("pin")]
+    if not msgs:
+        return
+    if relay is not None:
+        relay(msgs)
+    else:
+        publish(msgs)
+
+
+def publish(msgs: list) -> list:
+    """Stamp new events with the next seqs, keep them for replay and deliver them."""
+    for msg in msgs:
+        events.stamp(msg)
+    deliver(msgs)
+    return msgs
+
+
+def receive_events(msgs: list) -> None:
+    """Keep and deliver events another worker already stamped."""
+    for msg in msgs:
+        if "seq" in msg:
+            events.record(msg)
+    deliver(msgs)
+
+
+def deliver(msgs: list) -> None:
+    """
+    Fan messages out to this process's subscribers of their pins: one frame
+    per message, except on connections that asked for conflation, which
+    batch into array frames on their own.
+    """
+    for msg in msgs:
+        pin = msg.get("pin")
+        subscribers = pin_subscribers.get(pin)
+        if not subscribers:
+            continue
+        data = json.dumps(msg)
+        for conn in list(subscribers):
+            conn.push(pin, msg, data)
+
+
+def conflation_window(data: dict):
+    """
+    Read the optional conflation settings of a subscribe message:
+    {"pins": [...], "conflate": true, "window_ms": 100}.
+    """
+    if not data.get("conflate"):
+        return None
+    try:
+        return int(data.get("window_ms", WS_CONFLATE_WINDOW_MS))
+    except (TypeError, ValueError):
+        return WS_CONFLATE_WINDOW_MS
+
+
+def resume_point(data: dict):
+    """(stream, last_seq) from a subscribe message resuming after a reconnect, or None."""
+    stream = data.get("stream")
+    try:
+        last_seq = int(data["last_seq"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (stream, last_seq) if isinstance(stream, str) else None
+
+
+def send_resume(conn: Connection, pins, stream: str, last_seq: int) -> None:
+    """
+    Catch a reconnected client up: the events it missed where the buffer
+    still has them, else one snapshot frame with the current device state.
+    """
+    missed, stale = events.replay(pins, stream, last_seq)
+    for start in range(0, len(missed), REPLAY_FRAME_EVENTS):
+        conn.enqueue(None, json.dumps(missed[start:start + REPLAY_FRAME_EVENTS]))
+    if stale:
+        devices = [state.as_dict(registry.is_enabled(state)) for state in map(registry.get, stale) if state is not None]
+        snapshot = {"type": "snapshot", "stream": events.stream, "seq": events.seq, "devices": devices}
+        conn.enqueue(None, json.dumps(snapshot))
 
 
 @router.websocket("/ws")
@@ -53,9 +333,7 @@ async def websocket_endpoint(websocket: WebSocket):
         return
     
     await websocket.accept()
-    clients.add(websocket)
-    subscriptions[websocket] = set()
-    owners[websocket] = user_id
+    conn = register(websocket, user_id)
     
     try:
         while True:
@@ -64,28 +342,39 @@ async def websocket_endpoint(websocket: WebSocket):
                 if text.strip().lower() == "ping":
                     continue
                 pins = None
+                window_ms = None
+                resume = None
                 try:
                     data = json.loads(text)
                     if isinstance(data, dict) and isinstance(data.get("pins"), list):
                         pins = [str(p).strip() for p in data.get("pins") if str(p).strip()]
+                        window_ms = conflation_window(data)
+                        resume = resume_point(data)
                 except Exception:
                     tokens = [t.strip() for t in text.split(",") if t.strip()]
                     if tokens:
                         pins = tokens
 
                 if pins is not None:
-                    allowed = set()
-                    for pin in pins:
-                        if is_pin_owned_by_user(owners[websocket], pin):
-                            allowed.add(pin)
-                    subscriptions[websocket] = allowed
+                    allowed = await run_db(owned_pins, conn.user_id, pins) if pins else set()
+                    # No awaits from here on: the replay and the live feed join
+                    # at events.seq with nothing missed or repeated.
+                    set_subscriptions(conn, allowed)
+                    conn.set_conflation(window_ms)
 
-                    await websocket.send_text(json.dumps({"type": "subscribed", "pins": sorted(list(allowed))}))
+                    reply = {
+                        "type": "subscribed",
+                        "pins": sorted(list(allowed)),
+                        "stream": events.stream,
+                        "seq": events.seq,
+                    }
+                    if conn.conflate_window is not None:
+                        reply["conflate"] = True
+                        reply["window_ms"] = int(conn.conflate_window * 1000)
+                    conn.enqueue(None, json.dumps(reply))
+                    if resume is not None:
+                        send_resume(conn, sorted(allowed), *resume)
             except WebSocketDisconnect:
                 break
     finally:
-        if websocket in clients:
-            clients.remove(websocket)
-
-        subscriptions.pop(websocket, None)
-        owners.pop(websocket, None)
+        unregister(conn)
@@ -0,0 +1,172 @@
+"""
+A small in-process MQTT 3.1.1 broker for benchmarks.
+
+Enough of the protocol for the app's aiomqtt clients and for simulated
+devices: CONNECT, SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, PUBLISH at
+QoS 0/1/2 (always forwarded at QoS 0), PINGREQ and DISCONNECT. No
+retained messages, sessions or will messages.
+"""
+import asyncio
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+# A subscriber's socket buffer above this makes publishers wait for it.
+HIGH_WATER_BYTES = 1024 * 1024
+
+
+def encode_length(length: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        out.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(out)
+
+
+def packet(kind: int, flags: int, body: bytes) -> bytes:
+    return bytes([(kind << 4) | flags]) + encode_length(len(body)) + body
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("!H", len(data)) + data
+
+
+def publish_packet(topic: str, payload: bytes) -> bytes:
+    return packet(PUBLISH, 0, encode_string(topic) + payload)
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[index]:
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class Session:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.client_id = ""
+        self.filters = set()
+
+    def wants(self, topic: str) -> bool:
+        return any(topic_matches(topic_filter, topic) for topic_filter in self.filters)
+
+
+class Broker:
+    """
+    Routes PUBLISH packets between TCP clients. `publish()` injects messages
+    from inside the process (simulated devices); `on_publish(topic, payload)`
+    sees every message a client publishes (e.g. the app's reset commands).
+    """
+
+    def __init__(self, on_publish=None):
+        self.on_publish = on_publish
+        self.sessions = set()
+        self.server = None
+        self.port = None
+        self.subscribed = asyncio.Event()
+        self.routed = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.server = await asyncio.start_server(self.serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self) -> None:
+        for session in list(self.sessions):
+            session.writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def publish(self, topic: str, payload: bytes) -> None:
+        data = publish_packet(topic, payload)
+        slow = []
+        for session in list(self.sessions):
+            if session.wants(topic):
+                session.writer.write(data)
+                self.routed += 1
+                if session.writer.transport.get_write_buffer_size() > HIGH_WATER_BYTES:
+                    slow.append(session.writer)
+        for writer in slow:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = Session(writer)
+        self.sessions.add(session)
+        try:
+            while True:
+                first = await reader.readexactly(1)
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b""
+                if not await self.handle(session, first[0] >> 4, first[0] & 0x0F, body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    async def handle(self, session: Session, kind: int, flags: int, body: bytes) -> bool:
+        writer = session.writer
+        if kind == CONNECT:
+            name_length = struct.unpack_from("!H", body, 0)[0]
+            offset = 2 + name_length + 4  # protocol name, level, flags, keepalive
+            id_length = struct.unpack_from("!H", body, offset)[0]
+            session.client_id = body[offset + 2:offset + 2 + id_length].decode("utf-8", "replace")
+            writer.write(packet(CONNACK, 0, b"\x00\x00"))
+        elif kind == SUBSCRIBE:
+            packet_id = body[:2]
+            offset, granted = 2, bytearray()
+            while offset < len(body):
+                length = struct.unpack_from("!H", body, offset)[0]
+                session.filters.add(body[offset + 2:offset + 2 + length].decode("utf-8"))
+                granted.append(min(body[offset + 2 + length], 1))
+                offset += 3 + length
+            writer.write(packet(SUBACK, 0, packet_id + bytes(granted)))
+            self.subscribed.set()
+        elif kind == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                length = struct.unpack_from("!H", body, offset)[0]
+                session.filters.discard(body[offset + 2:offset + 2 + length].decode("utf-8"))
+                offset += 2 + length
+            writer.write(packet(UNSUBACK, 0, body[:2]))
+        elif kind == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            length = struct.unpack_from("!H", body, 0)[0]
+            topic = body[2:2 + length].decode("utf-8")
+            offset = 2 + length
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                writer.write(packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+            payload = body[offset:]
+            if self.on_publish is not None:
+                self.on_publish(topic, payload)
+            await self.publish(topic, payload)
+        elif kind == PUBREL:
+            writer.write(packet(PUBCOMP, 0, body[:2]))
+        elif kind == PINGREQ:
+            writer.write(packet(PINGRESP, 0, b""))
+        elif kind == DISCONNECT:
+            return False
+        return True
@@ -0,0 +1,60 @@
+"""
+Password hashing throughput: logins per second, total and per core.
+
+    python -m bench.passwords [--workers N] [--logins N]
+
+Runs verify_password through the same KDF pool the login route uses, with
+N worker threads, and reports how the rate scales with the pool size.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from app import passwords
+
+
+async def measure(workers: int, logins: int, stored: str) -> dict:
+    passwords.close_executor()
+    passwords.PASSWORD_HASH_WORKERS = workers
+    # Warm the pool so thread start-up is not counted.
+    await asyncio.gather(*[passwords.run_kdf(passwords.verify_password, stored, "pw") for _ in range(workers)])
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    results = await asyncio.gather(
+        *[passwords.run_kdf(passwords.verify_password, stored, "correct horse") for _ in range(logins)]
+    )
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    assert all(results)
+    rate = logins / elapsed
+    return {
+        "workers": workers,
+        "logins": logins,
+        "seconds": round(elapsed, 3),
+        "logins_per_second": round(rate, 1),
+        "logins_per_second_per_worker": round(rate / workers, 1),
+        "cpu_ms_per_login": round(cpu * 1000 / logins, 2),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="largest pool size to try")
+    parser.add_argument("--logins", type=int, default=200)
+    args = parser.parse_args()
+
+    stored = passwords.hash_password("correct horse")
+    sizes = sorted({1, max(1, args.workers // 2), args.workers})
+    report = {
+        "scrypt": {"n": passwords.PASSWORD_SCRYPT_N, "r": passwords.PASSWORD_SCRYPT_R, "p": passwords.PASSWORD_SCRYPT_P},
+        "cpu_count": os.cpu_count(),
+        "runs": [await measure(size, args.logins, stored) for size in sizes],
+    }
+    passwords.close_executor()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
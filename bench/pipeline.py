@@ -0,0 +1,373 @@
+"""
+End-to-end load test: MQTT publish -> ingest -> SQLite -> WebSocket frame.
+
+    python -m bench.pipeline [--devices 50] [--dashboards 10] [--rate 500]
+                             [--duration 10] [--toggle-devices 0] [--output out.json]
+                             [--payload json|empty|struct] [--batch 1]
+                             [--seq] [--redeliver 0.0] [--reboot]
+
+Starts a stand-in MQTT broker in this process and the app (bench.server) in a
+child process against a fresh database. It then publishes `count` (and
+optionally `toggle`) messages to {topic}/{pin}/{action} at a fixed rate,
+in the chosen payload format (JSON and binary count payloads can batch
+several events of one pin per message, and carry a device seq), with every
+pin watched by a simulated dashboard on /ws. It reports
+throughput, end-to-end latency percentiles, SQLite transaction times and
+event-loop lag as JSON (with --redeliver, re-sent seq'd messages must not
+show up as extra, "unmatched" counts; with --reboot, every device starts its
+seq over at 0 under a new boot halfway through, and none of the counts after
+that may be "lost"), so runs can be diffed to catch regressions in
+mqtt_consumer, apply_change or broadcast. Last of all it deletes a device
+and times the reset command through the MQTT publisher.
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from app.codecs import MAX_BATCH, encode_counts, encode_toggle
+from .broker import Broker
+from .server import percentiles_ms
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# mqtt_consumer wants at least two segments before {pin}/{action}.
+TOPIC = "bench/lab"
+# Events per pacing tick; also how often the publisher checks the clock.
+TICK_SECONDS = 0.005
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def prepare_database(args, env) -> dict:
+    """Create the users, devices and tokens in a fresh database before the app starts."""
+    os.environ.update(env)
+    from app.auth import issue_token
+    from app.db import create_user, init_db, link_pin_to_user, set_user_rfid
+    from app.pool import close_pool
+
+    init_db()
+    users = []
+    for index in range(args.dashboards):
+        user_id = create_user(f"bench{index}", "-")
+        users.append({"id": user_id, "token": issue_token(user_id, f"bench{index}"), "pins": []})
+    count_pins = [f"c{index}" for index in range(args.devices)]
+    for index, pin in enumerate(count_pins):
+        user = users[index % len(users)]
+        link_pin_to_user(user["id"], pin)
+        user["pins"].append(pin)
+
+    # Toggle devices get their own users: an authorized toggle flips every pin
+    # of its owner, which must not disable the pins being counted.
+    toggle_pins = []
+    for index in range(args.toggle_devices):
+        user_id = create_user(f"bench-toggle{index}", "-")
+        pin, badge = f"t{index}", f"BADGE{index}"
+        link_pin_to_user(user_id, pin)
+        set_user_rfid(user_id, badge)
+        users.append({"id": user_id, "token": issue_token(user_id, f"bench-toggle{index}"), "pins": [pin]})
+        toggle_pins.append((pin, badge))
+    close_pool()
+    return {"users": users, "count_pins": count_pins, "toggle_pins": toggle_pins}
+
+
+class Recorder:
+    """
+    Publish times keyed by the frame each publish should produce: (pin, n)
+    for the count event that makes the pin's count n (pins start at 0 and
+    only go up), (pin, "toggle", k) for the pin's k-th toggle.
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.latencies = []
+        self.next_count = {}
+        self.toggles_sent = {}
+        self.toggles_seen = {}
+        self.first_publish = None
+        self.last_delivery = None
+        self.unmatched = 0
+        self.redelivered = 0
+
+    def published(self, key) -> None:
+        now = time.perf_counter()
+        if self.first_publish is None:
+            self.first_publish = now
+        self.sent[key] = now
+
+    def received(self, event: dict) -> None:
+        now = time.perf_counter()
+        pin = event.get("pin")
+        if "new_count" in event:
+            # A conflated frame stands for every count up to new_count.
+            first = self.next_count.get(pin, 1)
+            self.next_count[pin] = max(first, event["new_count"] + 1)
+            keys = [(pin, n) for n in range(first, event["new_count"] + 1)]
+        elif "enabled" in event:
+            seen = self.toggles_seen.get(pin, 0) + 1
+            self.toggles_seen[pin] = seen
+            keys = [(pin, "toggle", seen)]
+        else:
+            return
+        for key in keys:
+            sent = self.sent.pop(key, None)
+            if sent is None:
+                self.unmatched += 1
+                continue
+            self.last_delivery = now
+            self.latencies.append(now - sent)
+
+
+async def dashboard(port: int, user: dict, recorder: Recorder, conflate_ms: int, ready: asyncio.Event) -> None:
+    import websockets
+
+    headers = {"Cookie": f"token={user['token']}"}
+    async with websockets.connect(f"ws://127.0.0.1:{port}/ws", additional_headers=headers, max_queue=None) as ws:
+        subscribe = {"pins": user["pins"]}
+        if conflate_ms:
+            subscribe.update(conflate=True, window_ms=conflate_ms)
+        await ws.send(json.dumps(subscribe))
+        async for frame in ws:
+            message = json.loads(frame)
+            if isinstance(message, dict) and message.get("type") == "subscribed":
+                ready.set()
+                continue
+            for event in message if isinstance(message, list) else [message]:
+                recorder.received(event)
+
+
+async def run_devices(broker: Broker, setup: dict, recorder: Recorder, args) -> int:
+    """Publish at args.rate events/s for args.duration seconds; returns how many were sent."""
+    count_pins = setup["count_pins"]
+    toggle_pins = setup["toggle_pins"]
+    seqs = {pin: 0 for pin in count_pins}
+    boots = {pin: 1 for pin in count_pins} if args.reboot else {}
+    redeliveries = random.Random(0)
+
+    def count_payload(pin: str) -> bytes:
+        if args.payload == "empty":
+            return b""
+        seq = None
+        if args.seq:
+            seqs[pin] += 1
+            seq = seqs[pin]
+        boot = boots.get(pin)
+        if args.payload == "struct":
+            return encode_counts(args.batch, seq=seq, boot=boot)
+        if seq is None and args.batch == 1:
+            return b"{}"
+        fields = {"n": args.batch}
+        if seq is not None:
+            fields["seq"] = seq
+        if boot is not None:
+            fields["boot"] = boot
+        return json.dumps(fields).encode("utf-8")
+
+    counts = {pin: 0 for pin in count_pins}
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    sent = toggles = 0
+    next_pin = 0
+    while True:
+        elapsed = loop.time() - start
+        if elapsed >= args.duration:
+            return sent
+        due = int(elapsed * args.rate) + 1
+        while sent < due:
+            pin = count_pins[next_pin % len(count_pins)]
+            next_pin += 1
+            if boots.get(pin) == 1 and elapsed >= args.duration / 2:
+                # The device restarts: seq 0 again, well inside the replay window.
+                boots[pin] = 2
+                seqs[pin] = -1
+            for _ in range(args.batch):
+                counts[pin] += 1
+                recorder.published((pin, counts[pin]))
+            payload = count_payload(pin)
+            await broker.publish(f"{TOPIC}/{pin}/count", payload)
+            if args.redeliver and redeliveries.random() < args.redeliver:
+                # As QoS 1 does after a lost PUBACK: the same message again.
+                await broker.publish(f"{TOPIC}/{pin}/count", payload)
+                recorder.redelivered += 1
+            sent += args.batch
+        if toggle_pins and toggles < int(elapsed * args.toggle_rate) + 1:
+            pin, badge = toggle_pins[toggles % len(toggle_pins)]
+            seen = recorder.toggles_sent.get(pin, 0) + 1
+            recorder.toggles_sent[pin] = seen
+            recorder.published((pin, "toggle", seen))
+            if args.payload == "struct":
+                payload = encode_toggle(badge)
+            else:
+                payload = json.dumps({"uuid": badge}).encode("utf-8")
+            await broker.publish(f"{TOPIC}/{pin}/toggle", payload)
+            toggles += 1
+        await asyncio.sleep(TICK_SECONDS)
+
+
+def delete_device(port: int, token: str, pin: str) -> int:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        conn.request(
+            "POST",
+            "/api/deleteDevice",
+            body=json.dumps({"pin": pin}),
+            headers={"Content-Type": "application/json", "Cookie": f"token={token}"},
+        )
+        return conn.getresponse().status
+    finally:
+        conn.close()
+
+
+async def wait_for_port(port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"app did not start listening on port {port}")
+            await asyncio.sleep(0.1)
+
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    resets = {}
+
+    def on_publish(topic: str, payload: bytes) -> None:
+        if topic.endswith("/reset"):
+            resets[topic.split("/")[-2]] = time.perf_counter()
+
+    broker = Broker(on_publish)
+    broker_port = await broker.start()
+    app_port = free_port()
+    env = {
+        "SQLITE_DB_PATH": os.path.join(workdir, "bench.sqlite3"),
+        "BROKER_URL": f"mqtt://127.0.0.1:{broker_port}",
+        "BROKER_TOPIC": TOPIC,
+    }
+    setup = prepare_database(args, env)
+
+    stats_path = os.path.join(workdir, "server-stats.json")
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    child = subprocess.Popen(
+        [sys.executable, "-m", "bench.server", "--port", str(app_port), "--stats", stats_path],
+        cwd=REPO_ROOT,
+        env={**os.environ, **env},
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    recorder = Recorder()
+    dashboards = []
+    try:
+        await wait_for_port(app_port, 30)
+        await asyncio.wait_for(broker.subscribed.wait(), 30)
+        ready = []
+        for user in setup["users"]:
+            event = asyncio.Event()
+            ready.append(event)
+            dashboards.append(asyncio.create_task(dashboard(app_port, user, recorder, args.conflate_ms, event)))
+        await asyncio.wait_for(asyncio.gather(*(event.wait() for event in ready)), 30)
+
+        published = await run_devices(broker, setup, recorder, args)
+        deadline = time.perf_counter() + args.drain
+        while recorder.sent and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        outstanding = len(recorder.sent)
+
+        # The delete route publishes {topic}/{pin}/reset through the MQTT publisher.
+        pin = setup["count_pins"][0]
+        start = time.perf_counter()
+        status = await asyncio.to_thread(delete_device, app_port, setup["users"][0]["token"], pin)
+        while pin not in resets and time.perf_counter() - start < 5:
+            await asyncio.sleep(0.01)
+        reset_ms = round((resets[pin] - start) * 1000, 3) if pin in resets else None
+    finally:
+        for task in dashboards:
+            task.cancel()
+        child.send_signal(signal.SIGTERM)
+        await asyncio.to_thread(child.wait, 30)
+        log.close()
+        await broker.stop()
+
+    with open(stats_path, encoding="utf-8") as f:
+        server = json.load(f)
+    span = (recorder.last_delivery or 0) - (recorder.first_publish or 0)
+    delivered = len(recorder.latencies)
+    return {
+        "config": {
+            "devices": args.devices,
+            "dashboards": args.dashboards,
+            "toggle_devices": args.toggle_devices,
+            "rate": args.rate,
+            "duration": args.duration,
+            "conflate_ms": args.conflate_ms,
+            "payload": args.payload,
+            "batch": args.batch,
+            "seq": args.seq,
+            "redeliver": args.redeliver,
+            "reboot": args.reboot,
+        },
+        "published": published,
+        "toggles": sum(recorder.toggles_sent.values()),
+        "delivered": delivered,
+        "lost": outstanding,
+        "unmatched": recorder.unmatched,
+        "redelivered": recorder.redelivered,
+        "throughput_eps": round(delivered / span, 1) if span > 0 else 0.0,
+        "latency_ms": {**percentiles_ms(recorder.latencies), "mean": round(sum(recorder.latencies) / max(1, delivered) * 1000, 3)},
+        "reset": {"status": status, "publish_ms": reset_ms},
+        "server": server,
+        "workdir": workdir,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="MQTT-to-WebSocket end-to-end benchmark")
+    parser.add_argument("--devices", type=int, default=50, help="pins sending count events")
+    parser.add_argument("--dashboards", type=int, default=10, help="WebSocket dashboards (one user each)")
+    parser.add_argument("--rate", type=float, default=500, help="count events per second, all devices together")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--toggle-devices", type=int, default=0, help="extra pins sending authorized toggles")
+    parser.add_argument("--toggle-rate", type=float, default=5, help="toggles per second, all toggle devices together")
+    parser.add_argument("--conflate-ms", type=int, default=0, help="subscribe with conflation at this window")
+    parser.add_argument("--drain", type=float, default=10, help="seconds to wait for in-flight events after the load")
+    parser.add_argument("--payload", choices=("json", "empty", "struct"), default="json", help="count payload format")
+    parser.add_argument("--batch", type=int, default=1, help="count events per message (json or struct payloads)")
+    parser.add_argument("--seq", action="store_true", help="tag count messages with a per-pin device seq")
+    parser.add_argument("--redeliver", type=float, default=0.0, help="fraction of count messages published twice")
+    parser.add_argument("--reboot", action="store_true", help="with --seq, restart every device's seq at 0 (new boot) halfway through")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+    if args.devices < 1 or args.dashboards < 1:
+        parser.error("--devices and --dashboards must be at least 1")
+    if not 1 <= args.batch <= MAX_BATCH:
+        parser.error(f"--batch must be 1..{MAX_BATCH}")
+    if args.batch > 1 and args.payload == "empty":
+        parser.error("--batch above 1 needs --payload json or struct")
+    if args.seq and args.payload == "empty":
+        parser.error("--seq needs --payload json or struct")
+    if args.reboot and not args.seq:
+        parser.error("--reboot needs --seq")
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+The app as bench.pipeline runs it: main:app under uvicorn, plus a probe
+measuring event-loop lag. On shutdown (SIGTERM) the server-side numbers are
+written as JSON to --stats.
+
+    python -m bench.server --port 8800 --stats /tmp/server-stats.json
+"""
+import argparse
+import asyncio
+import json
+import signal
+import uvicorn
+
+# How often the lag probe asks to be woken up.
+PROBE_INTERVAL = 0.01
+
+
+async def probe_loop_lag(samples: list) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(PROBE_INTERVAL)
+        samples.append(loop.time() - start - PROBE_INTERVAL)
+
+
+def percentiles_ms(values) -> dict:
+    values = sorted(values)
+    if not values:
+        return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+
+    def at(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 3)
+
+    return {"p50": at(0.5), "p99": at(0.99), "max": at(1.0)}
+
+
+async def serve(port: int, stats_path: str) -> None:
+    import main
+    from app.mqtt import dispatcher
+    from app.pool import get_pool
+    from app.registry import registry
+
+    pool = get_pool()
+    samples = []
+    # uvicorn re-raises the SIGTERM it shut down on once serve() returns;
+    # catch it so the stats below still get written.
+    signal.signal(signal.SIGTERM, lambda signum, frame: None)
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    probe = asyncio.create_task(probe_loop_lag(samples))
+    try:
+        await server.serve()
+    finally:
+        probe.cancel()
+        stats = {
+            "loop_lag_ms": percentiles_ms(samples),
+            "sqlite": pool.stats(),
+            "mqtt_shards": dispatcher.stats(),
+            "registry": registry.stats(),
+        }
+        with open(stats_path, "w", encoding="utf-8") as f:
+            json.dump(stats, f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the app for bench.pipeline")
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--stats", required=True, help="where to write server-side stats on exit")
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, args.stats))
+
+
+if __name__ == "__main__":
+    main()
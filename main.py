@@ -1,29 +1,47 @@
 import asyncio
+import zlib
 from contextlib import asynccontextmanager
 from typing import Optional
 
 from fastapi import FastAPI, HTTPException, Request, Form, status, Response
-from fastapi.responses import FileResponse, JSONResponse, RedirectResponse
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, StreamingResponse
 from starlette.staticfiles import StaticFiles
 
 from app.auth import authenticate_user, register_user, issue_token, verify_token
-from app.config import JWT_EXP_SECONDS
+from app.cluster import Cluster
+from app.config import BULK_MAX_PINS, CLUSTER_MODE, JWT_EXP_SECONDS, RFID_MAX_BADGES
 import time
 
 from app.db import (
     apply_change,
     get_current_count,
     get_logs,
-    get_user_rfid,
+    get_user_devices,
+    get_user_badges,
+    get_user_version,
     init_db,
     link_pin_to_user,
-    list_user_pins,
-    set_user_rfid,
+    link_pins_to_user,
+    owned_pins,
+    parse_device_mode,
+    set_user_devices_enabled,
+    set_user_devices_mode,
+    set_user_badges,
     set_device_mode,
     unlink_pin_from_user,
+    unlink_pins_from_user,
 )
-from app.mqtt import mqtt_consumer, publish_reset
-from app.ws import router as ws_router, broadcast
+from app.ingest import ingest_worker
+from app.logsetup import setup_logging, stop_logging
+from app.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, loop_lag_monitor, render as render_metrics
+from app.export import EXPORT_FORMATS, export_logs
+from app.passwords import close_executor
+from app.pool import close_pool, run_db
+from app.registry import registry
+from app.retention import retention_worker
+from app.rollups import get_stats
+from app.mqtt import mqtt_consumer, mqtt_publisher, publish_reset, publish_resets
+from app.ws import router as ws_router, broadcast, broadcast_many
 from app.mqtt import mqtt_consumer
 from app.ws import router as ws_router, broadcast
 
@@ -69,20 +87,39 @@ def decode_user_id(token: Optional[str]) -> Optional[int]:
 def has_valid_session(request: Request) -> bool:
     return decode_user_id(extract_token(request)) is not None
 
+def start_ingestion_services():
+    """Tasks that must run in exactly one process; listed in shutdown order."""
+    return [
+        asyncio.create_task(mqtt_consumer()),
+        asyncio.create_task(retention_worker()),
+        asyncio.create_task(ingest_worker()),
+    ]
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    setup_logging()
     init_db()
-    task = asyncio.create_task(mqtt_consumer())
-    app.state.mqtt_task = task
+    if CLUSTER_MODE:
+        # Several workers: the elected leader starts the ingestion services.
+        tasks = [asyncio.create_task(Cluster(start_ingestion_services).run())]
+    else:
+        tasks = start_ingestion_services()
+    tasks.insert(1, asyncio.create_task(mqtt_publisher()))
+    tasks.append(asyncio.create_task(loop_lag_monitor()))
+    app.state.tasks = tasks
     try:
         yield
     finally:
-        if task:
-            task.cancel()
+        for t in tasks:
+            t.cancel()
             try:
-                await task
-            except Exception:
+                await t
+            except (asyncio.CancelledError, Exception):
                 pass
+        close_pool()
+        close_executor()
+        stop_logging()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -90,6 +127,12 @@ app.include_router(ws_router)
 app.mount("/public", StaticFiles(directory="public"), name="public")
 
 
+@app.get("/metrics")
+async def metrics():
+    # Per process: in cluster mode each worker reports its own numbers.
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/")
 def root(request: Request):
     if has_valid_session(request):
@@ -107,6 +150,30 @@ def auth_user_id(request: Request) -> int:
     raise HTTPException(status_code=401, detail="Missing or invalid token")
 
 
+def state_etag(*parts) -> str:
+    # Always include the user id: a browser cache shared by two logins must
+    # not revalidate one user's copy with the other's version.
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    # Weak comparison: W/"x" and "x" name the same state.
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def cache_headers(etag: str) -> dict:
+    # private, no-cache: the browser may keep a copy but must revalidate it.
+    return {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag))
+
+
 def login_success_response(user_id: int, username: str) -> RedirectResponse:
     token = issue_token(user_id, username)
     return set_auth_cookie(
@@ -132,7 +199,7 @@ async def register_form(username: str = Form(...), password: str = Form(...)):
     import sqlite3
 
     try:
-        user_id = register_user(username, password)
+        user_id = await register_user(username, password)
     except sqlite3.IntegrityError:
         return redirect_with_error("/register", "2")
     return login_success_response(user_id, username)
@@ -142,7 +209,7 @@ async def register_form(username: str = Form(...), password: str = Form(...)):
 async def login_form(username: str = Form(...), password: str = Form(...)):
     username = username.strip()
     password = password.strip()
-    user = authenticate_user(username, password)
+    user = await authenticate_user(username, password)
     if not user:
         return redirect_with_error("/login", "1")
     return login_success_response(int(user["id"]), user["username"])
@@ -156,17 +223,37 @@ async def api_logout():
 @app.get("/api/me")
 async def api_me(request: Request):
     uid = auth_user_id(request)
-    return {
+    badges = await run_db(get_user_badges, uid)
+    rfid_tag = format(zlib.crc32("\n".join(badges).encode("utf-8")), "08x")
+    etag = state_etag("me", uid, await run_db(get_user_version, uid), rfid_tag)
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    snapshot = await run_db(get_user_devices, uid)
+    content = {
         "user_id": uid,
-        "pins": list_user_pins(uid),
-        "rfid_uid": get_user_rfid(uid),
+        "pins": snapshot["devices"],
+        # rfid_uid: the first badge, for clients that only know one.
+        "rfid_uid": badges[0] if badges else None,
+        "rfid_uids": badges,
     }
+    return JSONResponse(content, headers=cache_headers(state_etag("me", uid, snapshot["version"], rfid_tag)))
 
 
 @app.get("/api/devices")
-async def api_devices(request: Request):
+async def api_devices(request: Request, since: Optional[int] = None):
+    """
+    The user's devices. Plain requests get the list and an ETag that changes
+    with the user's state version (If-None-Match answers 304). With
+    ?since=<version> the reply is {"version", "full", "devices", "removed"}
+    holding only pins changed or unlinked after that version.
+    """
     uid = auth_user_id(request)
-    return list_user_pins(uid)
+    etag = state_etag(uid, await run_db(get_user_version, uid))
+    if not_modified(request, etag):
+        return not_modified_response(etag)
+    snapshot = await run_db(get_user_devices, uid, since)
+    content = snapshot if since is not None else snapshot["devices"]
+    return JSONResponse(content, headers=cache_headers(state_etag(uid, snapshot["version"])))
 
 
 @app.post("/api/devices")
@@ -175,7 +262,7 @@ async def api_add_device(request: Request, body: dict):
     pin = str(body.get("pin", "")).strip()
     if not pin:
         raise HTTPException(status_code=400, detail="pin required")
-    link_pin_to_user(uid, pin)
+    await run_db(link_pin_to_user, uid, pin)
     return {"ok": True}
 
 
@@ -189,7 +276,7 @@ async def api_delete_device(request: Request, body: dict):
 
     from app.db import is_pin_owned_by_user
 
-    if not is_pin_owned_by_user(uid, pin):
+    if not await run_db(is_pin_owned_by_user, uid, pin):
         raise HTTPException(status_code=403, detail="forbidden")
 
     try:
@@ -197,32 +284,119 @@ async def api_delete_device(request: Request, body: dict):
     except Exception:
         raise HTTPException(status_code=500, detail="mqtt error")
 
-    removed = unlink_pin_from_user(uid, pin)
+    removed = await run_db(unlink_pin_from_user, uid, pin)
     if not removed:
         raise HTTPException(status_code=404, detail="device not found")
     return {"ok": True}
 
 
+def bulk_pins(body) -> list:
+    """The "pins" list of a bulk request body, stripped; 400 unless 1..BULK_MAX_PINS non-empty pins."""
+    pins = body.get("pins") if isinstance(body, dict) else None
+    if not isinstance(pins, list) or not pins:
+        raise HTTPException(status_code=400, detail="pins required")
+    if len(pins) > BULK_MAX_PINS:
+        raise HTTPException(status_code=400, detail=f"at most {BULK_MAX_PINS} pins per request")
+    pins = [str(pin).strip() for pin in pins]
+    if not all(pins):
+        raise HTTPException(status_code=400, detail="empty pin")
+    return pins
+
+
+def bulk_response(results: dict, **extra) -> dict:
+    return {**extra, "results": [{"pin": pin, "status": status} for pin, status in results.items()]}
+
+
+@app.post("/api/bulk/link")
+async def api_bulk_link(request: Request, body: dict):
+    """Link many pins at once: {"pins": [...]}; per-pin status "linked" or "already_linked"."""
+    uid = auth_user_id(request)
+    pins = bulk_pins(body)
+    return bulk_response(await run_db(link_pins_to_user, uid, pins))
+
+
+@app.post("/api/bulk/unlink")
+async def api_bulk_unlink(request: Request, body: dict):
+    """
+    Delete many devices at once: {"pins": [...]}. Resets for every owned pin
+    are queued first, as one pipelined batch; per-pin status "unlinked" or
+    "not_found".
+    """
+    uid = auth_user_id(request)
+    pins = bulk_pins(body)
+    owned = await run_db(owned_pins, uid, pins)
+    try:
+        await publish_resets(pin for pin in pins if pin in owned)
+    except Exception:
+        raise HTTPException(status_code=500, detail="mqtt error")
+    return bulk_response(await run_db(unlink_pins_from_user, uid, pins))
+
+
+@app.post("/api/bulk/mode")
+async def api_bulk_mode(request: Request, body: dict):
+    """Set one mode on many pins: {"pins": [...], "mode": "decrement"}; per-pin "updated" or "forbidden"."""
+    uid = auth_user_id(request)
+    pins = bulk_pins(body)
+    try:
+        mode = parse_device_mode(str(body.get("mode") or ""))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return bulk_response(await run_db(set_user_devices_mode, uid, pins, mode), mode=mode)
+
+
+@app.post("/api/bulk/enabled")
+async def api_bulk_enabled(request: Request, body: dict):
+    """Enable or disable many pins: {"pins": [...], "enabled": true}; per-pin "updated" or "forbidden"."""
+    uid = auth_user_id(request)
+    pins = bulk_pins(body)
+    enabled = body.get("enabled")
+    if not isinstance(enabled, bool):
+        raise HTTPException(status_code=400, detail="enabled must be true or false")
+    results = await run_db(set_user_devices_enabled, uid, pins, enabled)
+    ts = int(time.time())
+    await broadcast_many(
+        {"pin": pin, "enabled": registry.is_enabled(registry.get(pin)), "ts": ts}
+        for pin, status in results.items()
+        if status == "updated" and registry.get(pin) is not None
+    )
+    return bulk_response(results, enabled=enabled)
+
+
 @app.post("/api/rfid")
 async def api_set_rfid(request: Request, body: dict):
+    """
+    Replace the user's badges: {"rfid_uid": "..."} for one, or
+    {"rfid_uids": [...]} for up to RFID_MAX_BADGES (an empty list removes
+    them all). 409 if another user holds one of them.
+    """
     uid = auth_user_id(request)
-    rfid_uid = str(body.get("rfid_uid", "")).strip()
-    if not rfid_uid:
+    if "rfid_uids" in body:
+        uids = body["rfid_uids"]
+        if not isinstance(uids, list):
+            raise HTTPException(status_code=400, detail="rfid_uids must be a list")
+    else:
+        uids = [body.get("rfid_uid", "")]
+    uids = list(dict.fromkeys(str(rfid_uid).strip() for rfid_uid in uids))
+    if not all(uids):
         raise HTTPException(status_code=400, detail="rfid_uid required")
-    set_user_rfid(uid, rfid_uid)
-    return {"ok": True, "rfid_uid": rfid_uid}
+    if len(uids) > RFID_MAX_BADGES:
+        raise HTTPException(status_code=400, detail=f"at most {RFID_MAX_BADGES} badges")
+    taken = await run_db(set_user_badges, uid, uids)
+    if taken:
+        raise HTTPException(status_code=409, detail="rfid_uid in use")
+    return {"ok": True, "rfid_uid": uids[0] if uids else None, "rfid_uids": uids}
 
 @app.post("/api/devices/{pin}/mode")
 async def api_set_device_mode(pin: str, request: Request, body: dict):
     uid = auth_user_id(request)
     from app.db import is_pin_owned_by_user
 
-    if not is_pin_owned_by_user(uid, pin):
+    if not await run_db(is_pin_owned_by_user, uid, pin):
         raise HTTPException(status_code=403, detail="forbidden")
 
     mode = body.get("mode") if isinstance(body, dict) else None
     try:
-        updated_mode = set_device_mode(pin, str(mode))
+        updated_mode = await run_db(set_device_mode, pin, str(mode))
     except ValueError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
     return {"pin": pin, "mode": updated_mode}
@@ -233,7 +407,7 @@ async def api_change_device(pin: str, request: Request, body: dict):
     uid = auth_user_id(request)
     from app.db import is_pin_owned_by_user
 
-    if not is_pin_owned_by_user(uid, pin):
+    if not await run_db(is_pin_owned_by_user, uid, pin):
         raise HTTPException(status_code=403, detail="forbidden")
 
     change = None
@@ -254,7 +428,7 @@ async def api_change_device(pin: str, request: Request, body: dict):
         raise HTTPException(status_code=400, detail="change must be -1 or 1")
 
     ts = int(time.time())
-    new_count = apply_change(pin=pin, change=change, ts=ts)
+    new_count = await run_db(apply_change, pin=pin, change=change, ts=ts)
     await broadcast(
         {
             "pin": pin,
@@ -267,24 +441,81 @@ async def api_change_device(pin: str, request: Request, body: dict):
 
 
 @app.get("/api/devices/{pin}")
-def api_device(pin: str, request: Request):
+async def api_device(pin: str, request: Request):
     uid = auth_user_id(request)
     from app.db import is_pin_owned_by_user
 
-    if not is_pin_owned_by_user(uid, pin):
+    if not await run_db(is_pin_owned_by_user, uid, pin):
         raise HTTPException(status_code=403, detail="forbidden")
-    count = get_current_count(pin)
+    count = await run_db(get_current_count, pin)
     return {"pin": pin, "current_count": count}
 
 
 @app.get("/api/logs/{pin}")
-def api_logs(pin: str, request: Request, limit: int = 50):
+async def api_logs(
+    pin: str,
+    request: Request,
+    response: Response,
+    limit: int = 50,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+):
     uid = auth_user_id(request)
     from app.db import is_pin_owned_by_user
 
-    if not is_pin_owned_by_user(uid, pin):
+    if not await run_db(is_pin_owned_by_user, uid, pin):
         raise HTTPException(status_code=403, detail="forbidden")
-    return get_logs(pin, limit=limit)
+    logs = await run_db(get_logs, pin, limit=limit, before=before, after=after, since=since, until=until)
+    if logs:
+        # Cursor for the next page in the same direction (?before= or ?after=).
+        response.headers["X-Next-Cursor"] = str(logs[-1]["id"])
+    return logs
+
+
+@app.get("/api/logs/{pin}/export")
+async def api_logs_export(
+    pin: str,
+    request: Request,
+    format: str = "ndjson",
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+):
+    uid = auth_user_id(request)
+    from app.db import is_pin_owned_by_user
+
+    if not await run_db(is_pin_owned_by_user, uid, pin):
+        raise HTTPException(status_code=403, detail="forbidden")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format must be ndjson or csv")
+    return StreamingResponse(
+        export_logs(pin, format, since=since, until=until),
+        media_type=EXPORT_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="logs-{pin}.{format}"'},
+    )
+
+
+@app.get("/api/stats/{pin}")
+async def api_stats(
+    pin: str,
+    request: Request,
+    granularity: str = "hour",
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+):
+    uid = auth_user_id(request)
+    from app.db import is_pin_owned_by_user
+
+    if not await run_db(is_pin_owned_by_user, uid, pin):
+        raise HTTPException(status_code=403, detail="forbidden")
+    if end is None:
+        end = int(time.time())
+    try:
+        buckets = await run_db(get_stats, pin, granularity, start, end)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return {"pin": pin, "granularity": granularity, "buckets": buckets}
 
 
 @app.get("/login")